@@ -3,7 +3,6 @@ import schedule
 from time import sleep
 from queue import Queue
 from sys import version
-from threading import Thread
 from os import environ as env
 from os import access, R_OK, getenv
 from distro import linux_distribution
@@ -16,14 +15,17 @@ from varken import structures  # noqa
 from varken.ombi import OmbiAPI
 from varken.overseerr import OverseerrAPI
 from varken.unifi import UniFiAPI
-from varken import VERSION, BRANCH, BUILD_DATE
+from varken import VERSION, BRANCH, BUILD_DATE, jsonbackend
 from varken.sonarr import SonarrAPI
 from varken.radarr import RadarrAPI
 from varken.lidarr import LidarrAPI
 from varken.iniparser import INIParser
 from varken.dbmanager import DBManager
-from varken.helpers import GeoIPHandler
+from varken.statestore import StateStore
+from varken.helpers import GeoIPHandler, boolcheck
 from varken.tautulli import TautulliAPI
+from varken.scheduler import WorkerPool
+from varken.webhooks import WebhookReceiver
 from varken.sickchill import SickChillAPI
 from varken.varkenlogger import VarkenLogger
 
@@ -31,11 +33,6 @@ from varken.varkenlogger import VarkenLogger
 PLATFORM_LINUX_DISTRO = ' '.join(x for x in linux_distribution() if x)
 
 
-def thread(job, **kwargs):
-    worker = Thread(target=job, kwargs=dict(**kwargs))
-    worker.start()
-
-
 if __name__ == "__main__":
     parser = ArgumentParser(prog='varken',
                             description='Command-line utility to aggregate data from the plex ecosystem into InfluxDB',
@@ -44,6 +41,8 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--data-folder", help='Define an alternate data folder location')
     parser.add_argument("-D", "--debug", action='store_true', help='Use to enable DEBUG logging. (Depreciated)')
     parser.add_argument("-ND", "--no_debug", action='store_true', help='Use to disable DEBUG logging')
+    parser.add_argument("-AL", "--async-logging", action='store_true',
+                        help='Write logs from a background thread. Low priority records are dropped if it falls behind')
 
     opts = parser.parse_args()
 
@@ -77,8 +76,11 @@ if __name__ == "__main__":
     elif opts.no_debug:
         opts.debug = False
 
+    if getenv('ASYNC_LOGGING') is not None:
+        opts.async_logging = boolcheck(getenv('ASYNC_LOGGING'))
+
     # Initiate the logger
-    vl = VarkenLogger(data_folder=DATA_FOLDER, debug=opts.debug)
+    vl = VarkenLogger(data_folder=DATA_FOLDER, debug=opts.debug, async_logging=opts.async_logging)
     vl.logger.info('Starting Varken...')
 
     vl.logger.info('Data folder is "%s"', DATA_FOLDER)
@@ -91,57 +93,80 @@ if __name__ == "__main__":
     vl.logger.info("Varken v%s-%s %s", VERSION, BRANCH, BUILD_DATE)
 
     CONFIG = INIParser(DATA_FOLDER)
-    DBMANAGER = DBManager(CONFIG.influx_server)
+    vl.logger.info('Decoding JSON with %s', jsonbackend.use(CONFIG.json_backend))
+    DBMANAGER = DBManager(CONFIG.influx_server, DATA_FOLDER)
+    # Only change detection keeps state across restarts, so no database is created unless a server uses it
+    STATESTORE = None
+    if any(server.change_detection for server in CONFIG.sonarr_servers + CONFIG.radarr_servers +
+           CONFIG.lidarr_servers + CONFIG.sickchill_servers):
+        STATESTORE = StateStore(DATA_FOLDER)
     QUEUE = Queue()
 
+    if CONFIG.engine == 'asyncio':
+        from varken.asyncengine import AsyncEngine
+        ENGINE = AsyncEngine(CONFIG.max_workers, CONFIG.max_connections, CONFIG.max_queued_jobs)
+        SUBMIT = ENGINE.submit
+    else:
+        ENGINE = None
+        POOL = WorkerPool(CONFIG.max_workers, CONFIG.max_queued_jobs)
+        SUBMIT = POOL.submit
+
+    WEBHOOKS = WebhookReceiver(CONFIG.webhook_server, SUBMIT)
+
     if CONFIG.sonarr_enabled:
         for server in CONFIG.sonarr_servers:
-            SONARR = SonarrAPI(server, DBMANAGER)
+            SONARR = SonarrAPI(server, DBMANAGER, STATESTORE)
+            WEBHOOKS.add('sonarr', server.id, SONARR)
             if server.queue:
                 at_time = schedule.every(server.queue_run_seconds).seconds
-                at_time.do(thread, SONARR.get_queue).tag("sonarr-{}-get_queue".format(server.id))
+                at_time.do(SUBMIT, SONARR.get_queue).tag("sonarr-{}-get_queue".format(server.id))
             if server.missing_days > 0:
                 at_time = schedule.every(server.missing_days_run_seconds).seconds
-                at_time.do(thread, SONARR.get_calendar, query="Missing").tag("sonarr-{}-get_missing".format(server.id))
+                at_time.do(SUBMIT, SONARR.get_calendar, query="Missing").tag(
+                    "sonarr-{}-get_missing".format(server.id))
             if server.future_days > 0:
                 at_time = schedule.every(server.future_days_run_seconds).seconds
-                at_time.do(thread, SONARR.get_calendar, query="Future").tag("sonarr-{}-get_future".format(server.id))
+                at_time.do(SUBMIT, SONARR.get_calendar, query="Future").tag(
+                    "sonarr-{}-get_future".format(server.id))
 
     if CONFIG.tautulli_enabled:
         GEOIPHANDLER = GeoIPHandler(DATA_FOLDER, CONFIG.tautulli_servers[0].maxmind_license_key)
-        schedule.every(12).to(24).hours.do(thread, GEOIPHANDLER.update)
+        schedule.every(12).to(24).hours.do(SUBMIT, GEOIPHANDLER.update)
         for server in CONFIG.tautulli_servers:
             TAUTULLI = TautulliAPI(server, DBMANAGER, GEOIPHANDLER)
+            WEBHOOKS.add('tautulli', server.id, TAUTULLI)
             if server.get_activity:
                 at_time = schedule.every(server.get_activity_run_seconds).seconds
-                at_time.do(thread, TAUTULLI.get_activity).tag("tautulli-{}-get_activity".format(server.id))
+                at_time.do(SUBMIT, TAUTULLI.get_activity).tag("tautulli-{}-get_activity".format(server.id))
             if server.get_stats:
                 at_time = schedule.every(server.get_stats_run_seconds).seconds
-                at_time.do(thread, TAUTULLI.get_stats).tag("tautulli-{}-get_stats".format(server.id))
+                at_time.do(SUBMIT, TAUTULLI.get_stats).tag("tautulli-{}-get_stats".format(server.id))
 
     if CONFIG.radarr_enabled:
         for server in CONFIG.radarr_servers:
-            RADARR = RadarrAPI(server, DBMANAGER)
+            RADARR = RadarrAPI(server, DBMANAGER, STATESTORE)
+            WEBHOOKS.add('radarr', server.id, RADARR)
             if server.get_missing:
                 at_time = schedule.every(server.get_missing_run_seconds).seconds
-                at_time.do(thread, RADARR.get_missing).tag("radarr-{}-get_missing".format(server.id))
+                at_time.do(SUBMIT, RADARR.get_missing).tag("radarr-{}-get_missing".format(server.id))
             if server.queue:
                 at_time = schedule.every(server.queue_run_seconds).seconds
-                at_time.do(thread, RADARR.get_queue).tag("radarr-{}-get_queue".format(server.id))
+                at_time.do(SUBMIT, RADARR.get_queue).tag("radarr-{}-get_queue".format(server.id))
 
     if CONFIG.lidarr_enabled:
         for server in CONFIG.lidarr_servers:
-            LIDARR = LidarrAPI(server, DBMANAGER)
+            LIDARR = LidarrAPI(server, DBMANAGER, STATESTORE)
+            WEBHOOKS.add('lidarr', server.id, LIDARR)
             if server.queue:
                 at_time = schedule.every(server.queue_run_seconds).seconds
-                at_time.do(thread, LIDARR.get_queue).tag("lidarr-{}-get_queue".format(server.id))
+                at_time.do(SUBMIT, LIDARR.get_queue).tag("lidarr-{}-get_queue".format(server.id))
             if server.missing_days > 0:
                 at_time = schedule.every(server.missing_days_run_seconds).seconds
-                at_time.do(thread, LIDARR.get_calendar, query="Missing").tag(
+                at_time.do(SUBMIT, LIDARR.get_calendar, query="Missing").tag(
                     "lidarr-{}-get_missing".format(server.id))
             if server.future_days > 0:
                 at_time = schedule.every(server.future_days_run_seconds).seconds
-                at_time.do(thread, LIDARR.get_calendar, query="Future").tag("lidarr-{}-get_future".format(
+                at_time.do(SUBMIT, LIDARR.get_calendar, query="Future").tag("lidarr-{}-get_future".format(
                     server.id))
 
     if CONFIG.ombi_enabled:
@@ -149,41 +174,43 @@ if __name__ == "__main__":
             OMBI = OmbiAPI(server, DBMANAGER)
             if server.request_type_counts:
                 at_time = schedule.every(server.request_type_run_seconds).seconds
-                at_time.do(thread, OMBI.get_request_counts).tag("ombi-{}-get_request_counts".format(server.id))
+                at_time.do(SUBMIT, OMBI.get_request_counts).tag("ombi-{}-get_request_counts".format(server.id))
             if server.request_total_counts:
                 at_time = schedule.every(server.request_total_run_seconds).seconds
-                at_time.do(thread, OMBI.get_all_requests).tag("ombi-{}-get_all_requests".format(server.id))
+                at_time.do(SUBMIT, OMBI.get_all_requests).tag("ombi-{}-get_all_requests".format(server.id))
             if server.issue_status_counts:
                 at_time = schedule.every(server.issue_status_run_seconds).seconds
-                at_time.do(thread, OMBI.get_issue_counts).tag("ombi-{}-get_issue_counts".format(server.id))
+                at_time.do(SUBMIT, OMBI.get_issue_counts).tag("ombi-{}-get_issue_counts".format(server.id))
 
     if CONFIG.sickchill_enabled:
         for server in CONFIG.sickchill_servers:
-            SICKCHILL = SickChillAPI(server, DBMANAGER)
+            SICKCHILL = SickChillAPI(server, DBMANAGER, STATESTORE)
             if server.get_missing:
                 at_time = schedule.every(server.get_missing_run_seconds).seconds
-                at_time.do(thread, SICKCHILL.get_missing).tag("sickchill-{}-get_missing".format(server.id))
+                at_time.do(SUBMIT, SICKCHILL.get_missing).tag("sickchill-{}-get_missing".format(server.id))
 
     if CONFIG.unifi_enabled:
         for server in CONFIG.unifi_servers:
             UNIFI = UniFiAPI(server, DBMANAGER)
             at_time = schedule.every(server.get_usg_stats_run_seconds).seconds
-            at_time.do(thread, UNIFI.get_usg_stats).tag("unifi-{}-get_usg_stats".format(server.id))
+            at_time.do(SUBMIT, UNIFI.get_usg_stats).tag("unifi-{}-get_usg_stats".format(server.id))
 
     if CONFIG.overseerr_enabled:
         for server in CONFIG.overseerr_servers:
             OVERSEERR = OverseerrAPI(server, DBMANAGER)
+            WEBHOOKS.add('overseerr', server.id, OVERSEERR)
             if server.get_request_total_counts:
                 at_time = schedule.every(server.request_total_run_seconds).seconds
-                at_time.do(thread, OVERSEERR.get_request_counts).tag(
+                at_time.do(SUBMIT, OVERSEERR.get_request_counts).tag(
                     "overseerr-{}-get_request_counts".format(server.id))
             if server.num_latest_requests_to_fetch > 0:
                 at_time = schedule.every(server.num_latest_requests_seconds).seconds
-                at_time.do(thread, OVERSEERR.get_latest_requests).tag(
+                at_time.do(SUBMIT, OVERSEERR.get_latest_requests).tag(
                     "overseerr-{}-get_latest_requests".format(server.id))
             if server.num_total_issue_counts > 0:
                 at_time = schedule.every(server.num_total_issue_counts).seconds
-                at_time.do(thread, OVERSEERR.get_issue_counts).tag("overseerr-{}-get_issue_counts".format(server.id))
+                at_time.do(SUBMIT, OVERSEERR.get_issue_counts).tag(
+                    "overseerr-{}-get_issue_counts".format(server.id))
 
     # Run all on startup
     SERVICES_ENABLED = [CONFIG.ombi_enabled, CONFIG.radarr_enabled, CONFIG.tautulli_enabled, CONFIG.unifi_enabled,
@@ -193,8 +220,14 @@ if __name__ == "__main__":
         vl.logger.error("All services disabled. Exiting")
         exit(1)
 
-    schedule.run_all()
+    if CONFIG.webhook_server.enabled:
+        WEBHOOKS.start()
+
+    if ENGINE:
+        ENGINE.run()
+    else:
+        schedule.run_all()
 
-    while schedule.jobs:
-        schedule.run_pending()
-        sleep(1)
+        while schedule.jobs:
+            schedule.run_pending()
+            sleep(1)
@@ -7,6 +7,8 @@ from logging import getLogger, StreamHandler, Formatter, DEBUG
 from varken.iniparser import INIParser
 from varken.dbmanager import DBManager
 from varken.helpers import GeoIPHandler
+from varken.checkpoint import ImportCheckpoint
+from varken.statestore import StateStore
 from varken.tautulli import TautulliAPI
 
 if __name__ == "__main__":
@@ -14,6 +16,8 @@ if __name__ == "__main__":
                             description='Tautulli historical import tool')
     parser.add_argument("-d", "--data-folder", help='Define an alternate data folder location')
     parser.add_argument("-D", "--days", default=30, type=int, help='Specify length of historical import')
+    parser.add_argument("-r", "--resume", action='store_true',
+                        help='Only import sessions newer than the last run. Safe to schedule nightly')
     opts = parser.parse_args()
 
     DATA_FOLDER = abspath(join(dirname(__file__), '..', 'data'))
@@ -38,10 +42,11 @@ if __name__ == "__main__":
             exit(1)
 
     CONFIG = INIParser(DATA_FOLDER)
-    DBMANAGER = DBManager(CONFIG.influx_server)
+    DBMANAGER = DBManager(CONFIG.influx_server, DATA_FOLDER)
 
     if CONFIG.tautulli_enabled:
-        GEOIPHANDLER = GeoIPHandler(DATA_FOLDER)
+        GEOIPHANDLER = GeoIPHandler(DATA_FOLDER, CONFIG.tautulli_servers[0].maxmind_license_key)
+        CHECKPOINT = ImportCheckpoint(StateStore(DATA_FOLDER))
         for server in CONFIG.tautulli_servers:
             TAUTULLI = TautulliAPI(server, DBMANAGER, GEOIPHANDLER)
-            TAUTULLI.get_historical(days=opts.days)
+            TAUTULLI.get_historical(days=opts.days, checkpoint=CHECKPOINT, resume=opts.resume)
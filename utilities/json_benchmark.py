@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+from json import dumps
+from random import Random
+from timeit import repeat
+from argparse import ArgumentParser
+
+from varken import jsonbackend
+
+
+def radarr_movies(count, rng):
+    """A /api/v3/movie response shaped like the one Radarr v4 returns"""
+    movies = []
+    for i in range(count):
+        title = f'Movie {i} ' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(20))
+        movies.append({
+            'title': title, 'originalTitle': title, 'originalLanguage': {'id': 1, 'name': 'English'},
+            'alternateTitles': [{'sourceType': 'tmdb', 'movieMetadataId': i, 'title': f'{title} {n}', 'id': n}
+                                for n in range(rng.randint(0, 6))],
+            'secondaryYearSourceId': 0, 'sortTitle': title.lower(), 'sizeOnDisk': rng.randint(0, 2 ** 36),
+            'status': 'released', 'overview': ' '.join(['lorem ipsum dolor sit amet'] * rng.randint(5, 20)),
+            'inCinemas': '2019-05-22T00:00:00Z', 'physicalRelease': '2019-09-10T00:00:00Z',
+            'digitalRelease': '2019-08-20T00:00:00Z',
+            'images': [{'coverType': kind, 'url': f'/MediaCover/{i}/{kind}.jpg?lastWrite=637245349370000000',
+                        'remoteUrl': f'https://image.tmdb.org/t/p/original/{i:016x}.jpg'}
+                       for kind in ('poster', 'fanart')],
+            'website': 'https://example.com', 'year': rng.randint(1950, 2024), 'hasFile': rng.random() < 0.8,
+            'youTubeTrailerId': 'dQw4w9WgXcQ', 'studio': 'Studio', 'path': f'/movies/{title}',
+            'qualityProfileId': 1, 'monitored': rng.random() < 0.9, 'minimumAvailability': 'released',
+            'isAvailable': True, 'folderName': f'/movies/{title}', 'runtime': rng.randint(80, 180),
+            'cleanTitle': title.replace(' ', '').lower(), 'imdbId': f'tt{i:07}', 'tmdbId': i,
+            'titleSlug': f'{i}-movie', 'certification': 'PG-13', 'genres': ['Action', 'Comedy', 'Drama'],
+            'tags': [], 'added': '2020-05-09T19:46:00Z',
+            'ratings': {source: {'votes': rng.randint(0, 10 ** 6), 'value': round(rng.random() * 10, 1),
+                                 'type': 'user'} for source in ('imdb', 'tmdb', 'metacritic', 'rottenTomatoes')},
+            'movieFile': {'movieId': i, 'relativePath': f'{title}.mkv', 'size': rng.randint(0, 2 ** 36),
+                          'dateAdded': '2020-05-09T19:46:00Z',
+                          'quality': {'quality': {'id': 7, 'name': 'Bluray-1080p'}},
+                          'mediaInfo': {'audioBitrate': 1509000, 'audioChannels': 5.1, 'audioCodec': 'DTS',
+                                        'videoCodec': 'x264', 'videoFps': 23.976, 'resolution': '1920x1080'}},
+            'popularity': rng.random() * 100, 'id': i
+        })
+    return movies
+
+
+def sonarr_calendar(count, rng):
+    """A /api/v3/calendar?includeSeries=true response shaped like the one Sonarr v3 returns"""
+    episodes = []
+    for i in range(count):
+        series_id = rng.randint(1, count // 10 + 1)
+        episodes.append({
+            'seriesId': series_id, 'tvdbId': i, 'episodeFileId': 0, 'seasonNumber': rng.randint(1, 10),
+            'episodeNumber': rng.randint(1, 24), 'title': f'Episode {i}', 'airDate': '2023-01-01',
+            'airDateUtc': '2023-01-02T02:00:00Z', 'overview': ' '.join(['lorem ipsum'] * rng.randint(5, 30)),
+            'hasFile': rng.random() < 0.5, 'monitored': True, 'unverifiedSceneNumbering': False, 'id': i,
+            'series': {'title': f'Series {series_id}', 'sortTitle': f'series {series_id}', 'status': 'continuing',
+                       'ended': False, 'overview': ' '.join(['lorem ipsum'] * 20), 'network': 'Network',
+                       'airTime': '21:00', 'images': [{'coverType': 'poster', 'url': f'/{series_id}.jpg'}],
+                       'seasons': [{'seasonNumber': n, 'monitored': True} for n in range(5)], 'year': 2010,
+                       'path': f'/tv/Series {series_id}', 'qualityProfileId': 1, 'seasonFolder': True,
+                       'monitored': True, 'tvdbId': series_id, 'imdbId': f'tt{series_id:07}', 'id': series_id,
+                       'genres': ['Drama'], 'tags': [], 'ratings': {'votes': 100, 'value': 8.1}}
+        })
+    return episodes
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog='json_benchmark',
+                            description='Time the installed JSON backends decoding *arr sized API responses')
+    parser.add_argument("-m", "--movies", default=5000, type=int, help='Number of Radarr movies in the payload')
+    parser.add_argument("-e", "--episodes", default=2000, type=int, help='Number of Sonarr episodes in the payload')
+    parser.add_argument("-r", "--repeat", default=5, type=int, help='Runs per backend, the fastest one counts')
+    opts = parser.parse_args()
+
+    rng = Random(0)
+    payloads = {
+        'radarr movies': dumps(radarr_movies(opts.movies, rng)).encode(),
+        'sonarr calendar': dumps(sonarr_calendar(opts.episodes, rng)).encode(),
+    }
+
+    backends = jsonbackend.available()
+    for payload_name, payload in payloads.items():
+        print(f'{payload_name}: {len(payload) / 2 ** 20:.1f} MiB')
+        timings = {}
+        for backend in backends:
+            jsonbackend.use(backend)
+            timings[backend] = min(repeat(lambda: jsonbackend.loads(payload), number=1, repeat=opts.repeat))
+        for backend, best in timings.items():
+            print(f'  {backend:<8} {best * 1000:8.1f} ms  {timings["json"] / best:4.1f}x')
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+from random import Random
+from argparse import ArgumentParser
+from tracemalloc import start, stop, take_snapshot
+
+from json_benchmark import radarr_movies, sonarr_calendar
+
+from varken.decoder import StructDecoder
+from varken.radarr import RadarrAPI
+from varken.sonarr import SonarrAPI
+from varken.structures import RadarrMovie, SonarrEpisode
+
+
+def measure(decoder, records):
+    """Return the bytes held by the records decoded from a list of API dicts"""
+    start()
+    before = take_snapshot()
+    decoded = decoder.decode_all(records)
+    after = take_snapshot()
+    stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del decoded
+    return size
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog='record_memory',
+                            description='Compare the memory held by NamedTuple and compact records of *arr data')
+    parser.add_argument("-m", "--movies", default=40000, type=int, help='Number of Radarr movies')
+    parser.add_argument("-e", "--episodes", default=20000, type=int, help='Number of Sonarr episodes')
+    opts = parser.parse_args()
+
+    rng = Random(0)
+    cases = {
+        'radarr movies': (radarr_movies(opts.movies, rng), RadarrMovie, RadarrAPI.movie_decoder),
+        'sonarr calendar': (sonarr_calendar(opts.episodes, rng), SonarrEpisode, SonarrAPI.calendar_decoder),
+    }
+
+    for case, (records, structure, compact_decoder) in cases.items():
+        print(f'{case}: {len(records)} records')
+        decoders = {
+            'namedtuple': StructDecoder(structure),
+            'namedtuple projection': StructDecoder(structure, fields=compact_decoder.projection),
+            'compact': compact_decoder,
+        }
+        for name, decoder in decoders.items():
+            size = measure(decoder, records)
+            print(f'  {name:<22} {size / 2 ** 20:8.2f} MiB {size / len(records):8.0f} bytes/record')
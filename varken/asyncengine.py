@@ -0,0 +1,203 @@
+import schedule
+import asyncio
+from functools import partial
+from threading import get_ident, Lock
+from collections import Counter
+from contextlib import contextmanager
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import InvalidSchema, SSLError, ConnectionError, ChunkedEncodingError, Timeout
+
+import aiohttp
+
+from varken import helpers, jsonbackend
+from varken.scheduler import job_name
+
+
+@contextmanager
+def client_errors():
+    """Raise aiohttp errors as the requests exceptions that connection_handler handles"""
+    try:
+        yield
+    except aiohttp.InvalidURL as e:
+        raise InvalidSchema(e)
+    except aiohttp.ClientSSLError as e:
+        raise SSLError(e)
+    except aiohttp.ClientPayloadError as e:
+        raise ChunkedEncodingError(e)
+    except asyncio.TimeoutError as e:
+        raise Timeout(e)
+    except aiohttp.ClientConnectionError as e:
+        raise ConnectionError(e)
+
+
+async def read_chunk(response, size):
+    with client_errors():
+        return await response.content.read(size)
+
+
+class AsyncResponse(object):
+    """
+    The parts of requests.Response that the collectors use, filled from an aiohttp response. A streamed
+    response keeps the aiohttp response open and reads its body on the loop a chunk at a time.
+    """
+    def __init__(self, url, status_code, headers, cookies, body=b'', stream=None, loop=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.cookies = cookies
+        self.body = body
+        self.stream = stream
+        self.loop = loop
+
+    @property
+    def content(self):
+        if self.stream is not None:
+            self.body = b''.join(self.iter_content(helpers.STREAM_CHUNK_SIZE))
+        return self.body
+
+    @property
+    def text(self):
+        return self.content.decode(errors='replace')
+
+    def json(self):
+        return jsonbackend.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        if self.stream is None:
+            for start in range(0, len(self.body), chunk_size):
+                yield self.body[start:start + chunk_size]
+            return
+
+        try:
+            while True:
+                future = asyncio.run_coroutine_threadsafe(read_chunk(self.stream, chunk_size), self.loop)
+                chunk = future.result()
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self.stream is not None:
+            self.loop.call_soon_threadsafe(self.stream.release)
+            self.stream = None
+
+
+class AsyncEngine(object):
+    """
+    Optional asyncio runtime. A single event loop drives every scheduled job as a task and performs all of
+    their HTTP requests through one shared aiohttp keep-alive connection pool. Jobs that are coroutine
+    functions are awaited on the loop and can await request() directly. The collectors are synchronous, so
+    they run on a bounded executor and only wait there while the loop does their I/O. Like WorkerPool, a job
+    that is still queued or running when it is scheduled again is skipped and counted as an overrun.
+    """
+    def __init__(self, workers=10, connection_limit=100, max_queue=100):
+        self.logger = getLogger()
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='varken-worker')
+        self.workers = workers
+        self.max_queue = max_queue
+        self.connection_limit = connection_limit
+        self.http = None
+        self.lock = Lock()
+        self.active = set()
+        self.overruns = Counter()
+        self.dropped = 0
+        # Jobs submitted before the loop runs, such as by an early webhook
+        self.held = []
+
+        helpers.async_engine = self
+
+    def submit(self, job, **kwargs):
+        key = (job, tuple(sorted(kwargs.items())))
+
+        with self.lock:
+            if key in self.active:
+                self.overruns[key] += 1
+                self.logger.warning('%s is still running. Skipping this run. (%s overruns)',
+                                    job_name(job, kwargs), self.overruns[key])
+                return
+            if len(self.active) >= self.workers + self.max_queue:
+                self.dropped += 1
+                self.logger.warning('Job queue is full (%s jobs waiting). Dropping this run of %s. (%s dropped)',
+                                    self.max_queue, job_name(job, kwargs), self.dropped)
+                return
+            self.active.add(key)
+
+            if self.loop_thread is None:
+                self.held.append((key, job, kwargs))
+            elif get_ident() == self.loop_thread:
+                self.loop.create_task(self.run_job(key, job, kwargs))
+            else:
+                # Webhooks submit jobs from their own threads
+                asyncio.run_coroutine_threadsafe(self.run_job(key, job, kwargs), self.loop)
+
+    async def run_job(self, key, job, kwargs):
+        try:
+            if asyncio.iscoroutinefunction(job):
+                await job(**kwargs)
+            else:
+                await self.loop.run_in_executor(self.executor, partial(job, **kwargs))
+        except Exception as e:
+            self.logger.exception('Unhandled error while running %s: %s', job_name(job, kwargs), e)
+        finally:
+            with self.lock:
+                self.active.discard(key)
+
+    def send(self, session, request, verify=True, timeout=None, stream=False):
+        # Jobs run on executor threads and hand their request to the loop. Anything else, such as the
+        # UniFi login done before the loop starts, falls back to the blocking session.
+        if not self.loop.is_running() or self.http is None or get_ident() == self.loop_thread:
+            return session.send(request, verify=verify, timeout=timeout, stream=stream)
+        future = asyncio.run_coroutine_threadsafe(self.request(request, verify, timeout, stream), self.loop)
+        return future.result()
+
+    async def request(self, request, verify, timeout, stream=False):
+        headers = {k: v for k, v in request.headers.items() if k.lower() != 'content-length'}
+        if isinstance(timeout, tuple):
+            timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        elif timeout is not None:
+            timeout = aiohttp.ClientTimeout(total=timeout)
+
+        with client_errors():
+            response = await self.http.request(request.method, request.url, headers=headers, data=request.body,
+                                               ssl=bool(verify), timeout=timeout, allow_redirects=False)
+            cookies = {name: morsel.value for name, morsel in response.cookies.items()}
+            if stream:
+                return AsyncResponse(str(response.url), response.status, response.headers, cookies,
+                                     stream=response, loop=self.loop)
+            try:
+                content = await response.read()
+            finally:
+                response.release()
+            return AsyncResponse(str(response.url), response.status, response.headers, cookies, body=content)
+
+    async def main(self):
+        connector = aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=60)
+        # Cookies stay with each collector's own session, they must not leak between servers
+        self.http = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+        self.logger.info('Running collectors on the asyncio engine (%s connections max)', self.connection_limit)
+
+        with self.lock:
+            self.loop_thread = get_ident()
+            for key, job, kwargs in self.held:
+                self.loop.create_task(self.run_job(key, job, kwargs))
+            self.held = []
+
+        try:
+            schedule.run_all()
+            while schedule.jobs:
+                schedule.run_pending()
+                await asyncio.sleep(1)
+        finally:
+            await self.http.close()
+
+    def run(self):
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.loop.close()
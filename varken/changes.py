@@ -0,0 +1,58 @@
+import re
+from time import monotonic
+from threading import Lock
+from logging import getLogger
+
+# A line's series key (measurement and tags) runs up to its first unescaped space
+SERIES = re.compile(rb'(?:[^\\ ]|\\.)*')
+
+
+class ChangeDetector(object):
+    """
+    Remembers the points each collector query wrote last time so that unchanged points are not written again.
+    New and changed points are written, series that disappeared get a single removed=1 point, and every
+    full_refresh_seconds all points are written again so dashboards looking at a time window keep their data.
+    With a StateStore the points are also kept on disk, so removals are still noticed across a restart.
+    """
+    def __init__(self, full_refresh_seconds=3600, statestore=None):
+        self.full_refresh_seconds = full_refresh_seconds
+        self.statestore = statestore
+        self.logger = getLogger()
+        self.lock = Lock()
+        self.state = {}
+        self.refreshed = {}
+
+    def changes(self, key, influx_payload):
+        """Return the lines of influx_payload that need writing, plus removal markers, and remember the rest"""
+        time = influx_payload.time.encode()
+        current = {}
+        for line in influx_payload.lines:
+            # Compare points without their timestamp, it changes every run
+            current[line[:-len(time)] if time and line.endswith(time) else line] = line
+
+        with self.lock:
+            previous = self.state.get(key)
+            if previous is None and self.statestore:
+                previous = self.statestore.members(f'changes:{key}')
+            self.state[key] = set(current)
+            # Always write everything on the first run after a start
+            full_refresh = key not in self.refreshed or (
+                monotonic() - self.refreshed[key] >= self.full_refresh_seconds)
+            if full_refresh:
+                self.refreshed[key] = monotonic()
+        previous = previous or set()
+
+        if self.statestore:
+            self.statestore.update_members(f'changes:{key}', added=current.keys() - previous,
+                                           removed=previous - current.keys())
+
+        lines = [line for point, line in current.items() if full_refresh or point not in previous]
+        changed = len(lines)
+
+        current_series = {SERIES.match(point).group() for point in current}
+        removed_series = {SERIES.match(point).group() for point in previous.difference(current)} - current_series
+        lines.extend(series + b' removed=1i' + time for series in sorted(removed_series))
+
+        self.logger.debug('%s: writing %s of %s points%s, %s removed', key, changed, len(current),
+                          ' (full refresh)' if full_refresh else '', len(removed_series))
+        return lines
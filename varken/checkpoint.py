@@ -0,0 +1,16 @@
+class ImportCheckpoint(object):
+    """
+    Remembers the last history row imported from each Tautulli server so an import can pick up where it stopped
+    """
+    namespace = 'tautulli-import'
+
+    def __init__(self, statestore):
+        self.statestore = statestore
+
+    def get(self, server_id):
+        """Return (row_id, started) of the last imported row of a server, or (0, None) if there is none"""
+        checkpoint = self.statestore.get(self.namespace, server_id, {})
+        return checkpoint.get('row_id', 0), checkpoint.get('started')
+
+    def set(self, server_id, row_id, started):
+        self.statestore.set(self.namespace, server_id, {'row_id': row_id, 'started': started})
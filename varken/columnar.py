@@ -0,0 +1,68 @@
+from itertools import compress
+from operator import attrgetter
+
+try:
+    import numpy
+    # numpy.fromiter only builds object arrays from 1.23 on, older releases use the list path
+    if tuple(int(part) for part in numpy.__version__.split('.')[:2]) < (1, 23):
+        numpy = None
+except ImportError:
+    numpy = None
+
+
+class ColumnBatch(object):
+    """
+    A library snapshot held as one column per field instead of one record per item, so that filtering and
+    status codes are done for the whole batch at once. Columns are NumPy object arrays when NumPy is installed
+    and plain lists otherwise, both give the same results.
+    """
+    def __init__(self, columns, size):
+        self.columns = columns
+        self.size = size
+
+    @classmethod
+    def from_records(cls, records, fields):
+        columns = {}
+        for field in fields:
+            column = list(map(attrgetter(field), records))
+            if numpy is not None:
+                column = numpy.fromiter(column, dtype=object, count=len(column))
+            columns[field] = column
+        return cls(columns, len(records))
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, field):
+        """Return a column as a list"""
+        column = self.columns[field]
+        return column if numpy is None else column.tolist()
+
+    def truth(self, field):
+        column = self.columns[field]
+        if numpy is None:
+            return [bool(value) for value in column]
+        return column.astype(bool)
+
+    def select(self, true=(), false=()):
+        """Return the batch of rows where every field in true is truthy and every field in false is not"""
+        if numpy is not None:
+            mask = numpy.ones(self.size, dtype=bool)
+            for field in true:
+                mask &= self.truth(field)
+            for field in false:
+                mask &= ~self.truth(field)
+            return ColumnBatch({field: column[mask] for field, column in self.columns.items()}, int(mask.sum()))
+
+        mask = [True] * self.size
+        for field in true:
+            mask = [keep and bool(value) for keep, value in zip(mask, self.columns[field])]
+        for field in false:
+            mask = [keep and not value for keep, value in zip(mask, self.columns[field])]
+        return ColumnBatch({field: list(compress(column, mask)) for field, column in self.columns.items()}, sum(mask))
+
+    def choose(self, field, true_value, false_value):
+        """Return a list holding true_value where field is truthy and false_value where it is not"""
+        if numpy is None:
+            return [true_value if value else false_value for value in self.columns[field]]
+        return numpy.where(self.truth(field), true_value, false_value).tolist()
@@ -1,14 +1,32 @@
 import re
 from sys import exit
-from logging import getLogger
-from influxdb_client import InfluxDBClient
+from random import random
+from collections import Counter
+from atexit import register
+from os.path import join
+from time import monotonic
+from queue import Queue, Empty
+from logging import getLogger, DEBUG
+from threading import Thread, Event, Condition
+from influxdb_client import InfluxDBClient, Point
 from influxdb_client.client.write_api import SYNCHRONOUS
 from influxdb_client.client.exceptions import InfluxDBError
-from urllib3.exceptions import NewConnectionError
+from urllib3.exceptions import NewConnectionError, HTTPError
+
+from varken.spool import WriteSpool
+
+# The measurement of a line of line protocol runs up to its first unescaped comma or space
+MEASUREMENT = re.compile(rb'(?:[^\\, ]|\\.)*')
 
 
 class DBManager(object):
-    def __init__(self, server):
+    spool_folder = 'spool'
+    replay_interval = 10
+    # Buffered writes hold at most this many batches of points, collectors wait up to queue_full_timeout for room
+    queued_batches = 10
+    queue_full_timeout = 5
+
+    def __init__(self, server, data_folder=None):
         self.server = server
         self.logger = getLogger()
         self.bucket = "varken"
@@ -51,6 +69,30 @@ class DBManager(object):
         else:
             self.create_v1_database()
 
+        # A single write api is reused for every write instead of building one per call
+        self.write_api = self.influx.write_api(write_options=SYNCHRONOUS)
+
+        self.write_queue = None
+        if self.server.buffered_writes:
+            self.write_queue = Queue()
+            self.queued_points = 0
+            self.max_queued_points = self.server.batch_size * self.queued_batches
+            self.queue_condition = Condition()
+            self.flusher = Thread(target=self.flush_worker, name='influxdb-flusher', daemon=True)
+            self.flusher.start()
+            self.logger.info('Buffering InfluxDB writes (batch size: %s, flush interval: %ss)',
+                             self.server.batch_size, self.server.flush_interval)
+
+        self.spool = None
+        self.replay_stop = Event()
+        self.replay_offset = (None, 0)
+        if self.server.spool and data_folder:
+            self.spool = WriteSpool(join(data_folder, self.spool_folder), self.server.spool_max_mb * 1000000)
+            self.replayer = Thread(target=self.replay_worker, name='influxdb-spool-replay', daemon=True)
+            self.replayer.start()
+
+        register(self.close)
+
     def create_v2_bucket(self):
         if not self.influx.buckets_api().find_bucket_by_name(self.bucket):
             self.logger.info("Creating varken bucket")
@@ -78,11 +120,162 @@ class DBManager(object):
         self.bucket = f'{self.bucket}/varken 30d-1h'
 
     def write_points(self, data):
-        d = data
-        self.logger.debug('Writing Data to InfluxDB %s', d)
-        write_api = self.influx.write_api(write_options=SYNCHRONOUS)
+        if self.logger.isEnabledFor(DEBUG):
+            self.trace(data)
+        if self.write_queue is None:
+            self.write(data)
+        elif not self.enqueue(data):
+            # InfluxDB is not keeping up. Spool the overflow, or make the collector wait for the write itself
+            if self.spool is not None:
+                self.spool.append(self.line_protocol(data))
+                self.logger.warning('InfluxDB write queue is full. Spooled %s points to disk for replay', len(data))
+            else:
+                self.logger.warning('InfluxDB write queue is full. Writing %s points directly', len(data))
+                self.write(data)
+
+    def enqueue(self, data):
+        """Queue data for the flusher, unless the queue is still full after queue_full_timeout seconds"""
+        with self.queue_condition:
+            # A payload bigger than the whole queue is let in once the queue is empty
+            if not self.queue_condition.wait_for(
+                    lambda: self.queued_points + len(data) <= self.max_queued_points or not self.queued_points,
+                    timeout=self.queue_full_timeout):
+                return False
+            self.queued_points += len(data)
+        self.write_queue.put(data)
+        return True
+
+    def trace(self, data):
+        """Log a summary of a write, and with payload_log_sample set, a truncated dump of a sample of them"""
+        measurements = Counter()
+        size = 0
+        estimated = False
+        for point in data:
+            if isinstance(point, bytes):
+                size += len(point)
+                measurements[MEASUREMENT.match(point).group().decode()] += 1
+            else:
+                size += self.estimate_size(point)
+                estimated = True
+                measurements[point.get('measurement')] += 1
+        self.logger.debug('Writing %s points (%s%s bytes of line protocol) to InfluxDB: %s', len(data),
+                          '~' if estimated else '', size,
+                          ', '.join(f'{measurement}={count}' for measurement, count in measurements.items()))
+
+        if self.server.payload_log_sample and random() < self.server.payload_log_sample:
+            payload = repr(data)
+            max_chars = self.server.payload_log_max_chars
+            if len(payload) > max_chars:
+                payload = f'{payload[:max_chars]}... ({len(payload) - max_chars} more characters)'
+            self.logger.debug('Sampled InfluxDB payload: %s', payload)
+
+    @staticmethod
+    def estimate_size(point):
+        """Approximate line protocol size of a dict point, without serializing it"""
+        size = len(str(point.get('measurement', ''))) + 20
+        for key, value in point.get('tags', {}).items():
+            size += len(key) + len(str(value)) + 2
+        for key, value in point.get('fields', {}).items():
+            size += len(key) + len(str(value)) + 3
+        return size
+
+    def write(self, data):
+        started = monotonic()
         try:
-            write_api.write(bucket=self.bucket, record=data)
-        except (InfluxDBError, NewConnectionError) as e:
-            self.logger.error('Error writing data to influxdb. Dropping this set of data. '
-                              'Check your database! Error: %s', e)
+            self.write_api.write(bucket=self.bucket, record=data)
+            self.logger.debug('Wrote %s points to InfluxDB in %.0f ms', len(data), (monotonic() - started) * 1000)
+        except (InfluxDBError, HTTPError) as e:
+            if self.spool is not None and self.retryable(e):
+                self.spool.append(self.line_protocol(data))
+                self.logger.warning('Error writing data to influxdb. Spooled %s points to disk for replay. '
+                                    'Error: %s', len(data), e)
+            else:
+                self.logger.error('Error writing data to influxdb. Dropping this set of data. '
+                                  'Check your database! Error: %s', e)
+
+    @staticmethod
+    def retryable(error):
+        # No status means InfluxDB never answered. 429 and 5xx are worth retrying, other 4xx never will be
+        status = getattr(error, 'status', None)
+        if status is None and getattr(error, 'response', None) is not None:
+            status = error.response.status
+        return status is None or status == 429 or status >= 500
+
+    @staticmethod
+    def line_protocol(data):
+        lines = (point if isinstance(point, bytes) else Point.from_dict(point).to_line_protocol().encode()
+                 for point in data)
+        return [line for line in lines if line]
+
+    def replay_worker(self):
+        while not self.replay_stop.wait(self.replay_interval):
+            self.replay()
+
+    def replay(self):
+        rate = self.server.spool_replay_rate
+        segment = self.spool.claim()
+
+        while segment and not self.replay_stop.is_set():
+            lines = self.spool.read(segment)
+            offset = self.replay_offset[1] if self.replay_offset[0] == segment else 0
+            self.logger.info('Replaying %s spooled lines from %s to InfluxDB', len(lines) - offset, segment)
+
+            while offset < len(lines):
+                started = monotonic()
+                chunk = lines[offset:offset + rate]
+                try:
+                    self.write_api.write(bucket=self.bucket, record=chunk)
+                except (InfluxDBError, HTTPError) as e:
+                    if self.retryable(e):
+                        self.replay_offset = (segment, offset)
+                        self.logger.debug('InfluxDB is still unavailable. Retrying spool replay in %ss. Error: %s',
+                                          self.replay_interval, e)
+                        return
+                    self.logger.error('InfluxDB rejected %s spooled lines. Dropping them. Error: %s', len(chunk), e)
+                offset += len(chunk)
+                # Cap replay throughput at spool_replay_rate lines per second
+                if self.replay_stop.wait(max(1 - (monotonic() - started), 0)):
+                    self.replay_offset = (segment, offset)
+                    return
+
+            self.spool.release(segment)
+            self.replay_offset = (None, 0)
+            segment = self.spool.claim()
+
+    def flush_worker(self):
+        batch = []
+        deadline = None
+        running = True
+
+        while running:
+            timeout = max(deadline - monotonic(), 0) if batch else None
+            try:
+                data = self.write_queue.get(timeout=timeout)
+            except Empty:
+                data = []
+
+            if data:
+                with self.queue_condition:
+                    self.queued_points -= len(data)
+                    self.queue_condition.notify_all()
+
+            if data is None:
+                running = False
+            elif data:
+                if not batch:
+                    deadline = monotonic() + self.server.flush_interval
+                batch.extend(data)
+
+            while len(batch) >= self.server.batch_size:
+                self.write(batch[:self.server.batch_size])
+                batch = batch[self.server.batch_size:]
+
+            if batch and (not running or monotonic() >= deadline):
+                self.write(batch)
+                batch = []
+
+    def close(self):
+        if self.write_queue is not None and self.flusher.is_alive():
+            self.write_queue.put(None)
+            self.flusher.join()
+        self.replay_stop.set()
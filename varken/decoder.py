@@ -0,0 +1,128 @@
+from threading import Lock
+from logging import getLogger, DEBUG, WARNING
+
+record_types = {}
+record_types_lock = Lock()
+
+
+class CompactRecord(object):
+    """
+    Base of the slotted record classes made by record_type. Reads like the NamedTuple it stands in for.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def _asdict(self):
+        return {field: getattr(self, field) for field in self._fields}
+
+    def __repr__(self):
+        values = ', '.join(f'{field}={getattr(self, field)!r}' for field in self.__slots__)
+        return f'{type(self).__name__}({values})'
+
+
+def record_type(structure, fields):
+    """
+    Return a slotted class with the attributes of a varken.structures NamedTuple where only `fields` take space in
+    each instance. The other fields read as their default from the class. Made once per structure and fields.
+    """
+    key = (structure, frozenset(fields))
+    with record_types_lock:
+        if key not in record_types:
+            namespace = {
+                '__slots__': tuple(field for field in structure._fields if field in key[1]),
+                '_fields': structure._fields
+            }
+            for field in structure._fields:
+                if field not in key[1]:
+                    namespace[field] = structure._field_defaults.get(field)
+            record_types[key] = type(f'{structure.__name__}Record', (CompactRecord,), namespace)
+        return record_types[key]
+
+
+class StructDecoder(object):
+    """
+    Builds one of the varken.structures NamedTuples from API dicts through a function compiled once per structure.
+    Only the structure's fields are read, optionally only a projection of them with the rest left at their default.
+    Unknown keys are ignored, missing ones get their default, and both are reported once per structure instead
+    of for every record. With compact, records are slotted classes from record_type that only store the projection,
+    for the structures a job holds thousands of.
+    """
+    # Records checked for schema drift, one in every drift_sample
+    drift_sample = 100
+
+    def __init__(self, structure, fields=None, compact=False):
+        self.structure = structure
+        self.name = structure.__name__
+        self.fields = frozenset(structure._fields)
+        self.projection = self.fields if fields is None else frozenset(fields)
+        # Only a declared projection lists fields the collector reads, a full structure is mostly optional fields
+        self.missing_level = DEBUG if fields is None else WARNING
+        unknown_projection = self.projection - self.fields
+        if unknown_projection:
+            raise ValueError(f'{self.name} has no fields {sorted(unknown_projection)}')
+        self.record = record_type(structure, self.projection) if compact else None
+        self.logger = getLogger()
+        self.lock = Lock()
+        self.decoded = 0
+        self.unknown_keys = set()
+        self.missing_keys = set()
+        self.decode = self.compile()
+
+    def compile(self):
+        if self.record is not None:
+            return self.compile_compact()
+        namespace = {'new': tuple.__new__, 'structure': self.structure}
+        items = []
+        for index, field in enumerate(self.structure._fields):
+            namespace[f'd{index}'] = self.structure._field_defaults.get(field)
+            items.append(f'get({field!r}, d{index})' if field in self.projection else f'd{index}')
+        source = f'def decode(obj):\n    get = obj.get\n    return new(structure, ({", ".join(items)},))\n'
+        exec(source, namespace)
+        return namespace['decode']
+
+    def compile_compact(self):
+        namespace = {'new': object.__new__, 'record': self.record}
+        lines = ['def decode(obj):', '    get = obj.get', '    decoded = new(record)']
+        for index, field in enumerate(self.record.__slots__):
+            namespace[f'd{index}'] = self.structure._field_defaults.get(field)
+            lines.append(f'    decoded.{field} = get({field!r}, d{index})')
+        lines.append('    return decoded')
+        exec('\n'.join(lines) + '\n', namespace)
+        return namespace['decode']
+
+    def __call__(self, obj):
+        decoded = self.decode_all([obj])
+        return decoded[0] if decoded else None
+
+    def decode_all(self, objs):
+        """Decode a list of dicts, skipping anything that is not a dict, and report any new schema drift"""
+        decode = self.decode
+        decoded = []
+        unknown_keys = set()
+        missing_keys = set()
+        skipped = 0
+        for count, obj in enumerate(objs, self.decoded):
+            if not isinstance(obj, dict):
+                skipped += 1
+                continue
+            if not count % self.drift_sample:
+                keys = obj.keys()
+                unknown_keys.update(keys - self.fields)
+                missing_keys.update(self.projection - keys)
+            decoded.append(decode(obj))
+
+        with self.lock:
+            self.decoded += len(decoded)
+            new_unknown = unknown_keys - self.unknown_keys
+            new_missing = missing_keys - self.missing_keys
+            self.unknown_keys |= new_unknown
+            self.missing_keys |= new_missing
+
+        if new_unknown:
+            self.logger.debug('Ignoring fields not in %s: %s', self.name, sorted(new_unknown))
+        if new_missing:
+            self.logger.log(self.missing_level, 'Fields of %s missing from the API response, using defaults: %s',
+                            self.name, sorted(new_missing))
+        if skipped:
+            self.logger.error('Skipped %s records that could not be decoded as %s', skipped, self.name)
+        return decoded
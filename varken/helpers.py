@@ -1,37 +1,85 @@
 from hashlib import md5
 from datetime import date, timedelta
-from time import sleep
+from time import sleep, monotonic
+from threading import Lock, Condition
+from collections import deque, OrderedDict
 from logging import getLogger
+from urllib.parse import urlsplit
+from requests import Request
+from concurrent.futures import ThreadPoolExecutor
 from ipaddress import IPv4Address
 from urllib.error import HTTPError, URLError
+from maxminddb import MODE_MMAP_EXT, MODE_MMAP
+from shutil import copyfileobj
 from geoip2.database import Reader
-from tarfile import open as taropen
+from geoip2.errors import AddressNotFoundError
+from email.utils import formatdate
+from tarfile import open as taropen, TarError
 from urllib3 import disable_warnings
-from os import stat, remove, makedirs
-from urllib.request import urlretrieve
-from json.decoder import JSONDecodeError
-from os.path import abspath, join, basename, isdir
+from os import stat, remove, makedirs, replace, utime
+from urllib.request import urlopen, Request as URLRequest
+from codecs import getincrementaldecoder
+from json.decoder import JSONDecoder, JSONDecodeError
+from os.path import abspath, join, isdir
 from urllib3.exceptions import InsecureRequestWarning
-from requests.exceptions import InvalidSchema, SSLError, ConnectionError, ChunkedEncodingError
+from requests.exceptions import InvalidSchema, SSLError, ConnectionError, ChunkedEncodingError, Timeout
+
+from varken import jsonbackend
+from varken.structures import QueuePages
 
 logger = getLogger()
 
+# Set by AsyncEngine so that requests are sent through its shared event loop connection pool
+async_engine = None
+
+# (connect, read) timeout in seconds used when a collector does not pass its own
+DEFAULT_TIMEOUT = (5, 30)
+RETRIES = 2
+RETRY_BACKOFF = 1
+RETRY_STATUSES = (500, 502, 503, 504)
+# Pages of paged endpoints fetched at the same time, across every job, through one shared pool
+PAGE_WORKERS = 4
+page_pool = None
+page_pool_lock = Lock()
+# Bytes read at a time from responses parsed as a stream
+STREAM_CHUNK_SIZE = 65536
+
+circuit_breakers = {}
+circuit_breakers_lock = Lock()
+
 
 class GeoIPHandler(object):
-    def __init__(self, data_folder, maxmind_license_key):
+    download_url = ('https://download.maxmind.com/app/geoip_download?edition_id=GeoLite2-City'
+                    '&suffix=tar.gz&license_key={license_key}')
+    # Lookups kept in the LRU cache, and how long in seconds each one stays valid
+    cache_size = 1024
+    cache_ttl = 3600
+
+    def __init__(self, data_folder, maxmind_license_key, download_url=None):
         self.data_folder = data_folder
         self.maxmind_license_key = maxmind_license_key
+        if download_url:
+            self.download_url = download_url
         self.dbfile = abspath(join(self.data_folder, 'GeoLite2-City.mmdb'))
         self.logger = getLogger()
         self.reader = None
+        # Lookups in progress per reader, so that a replaced reader is only closed once they are done
+        self.in_flight = {}
+        self.reader_condition = Condition()
+        self.cache = OrderedDict()
+        self.cache_lock = Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.reader_manager(action='open')
 
         self.logger.info('Opening persistent connection to the MaxMind DB...')
 
     def reader_manager(self, action=None):
+        # Cached results belong to the database they were read from
+        self.clear_cache()
         if action == 'open':
             try:
-                self.reader = Reader(self.dbfile)
+                self.reader = self.open_reader()
             except FileNotFoundError:
                 self.logger.error("Could not find MaxMind DB! Downloading!")
                 result_status = self.download()
@@ -39,15 +87,77 @@ class GeoIPHandler(object):
                     self.logger.error("Could not download MaxMind DB! You may need to manually install it.")
                     exit(1)
                 else:
-                    self.reader = Reader(self.dbfile)
+                    self.reader = self.open_reader()
         else:
             self.reader.close()
 
+    def open_reader(self):
+        # Memory map the database so every process using the same file shares a single copy in the page cache,
+        # through the C extension when it is installed
+        try:
+            return Reader(self.dbfile, mode=MODE_MMAP_EXT)
+        except ValueError:
+            return Reader(self.dbfile, mode=MODE_MMAP)
+
+    def swap_reader(self):
+        """Start using the database on disk, closing the previous reader once lookups using it have finished"""
+        reader = self.open_reader()
+        with self.reader_condition:
+            old_reader, self.reader = self.reader, reader
+            self.reader_condition.wait_for(lambda: old_reader not in self.in_flight)
+        self.clear_cache()
+        if old_reader:
+            old_reader.close()
+
     def lookup(self, ipaddress):
         ip = ipaddress
         self.logger.debug('Getting lat/long for Tautulli stream using ip with last octet ending in %s',
                           ip.split('.')[-1:][0])
-        return self.reader.city(ip)
+        with self.cache_lock:
+            cached = self.cache.get(ip)
+            if cached and monotonic() < cached[0]:
+                self.cache.move_to_end(ip)
+                self.cache_hits += 1
+                return self.cached_result(cached[1])
+            self.cache_misses += 1
+
+        with self.reader_condition:
+            reader = self.reader
+            self.in_flight[reader] = self.in_flight.get(reader, 0) + 1
+        try:
+            try:
+                result = reader.city(ip)
+            except AddressNotFoundError as e:
+                # Private addresses show up every poll, remember that they are not in the database either
+                result = e
+
+            # Cache while still in flight, so a swap_reader waiting on this reader clears the result afterwards
+            with self.cache_lock:
+                self.cache[ip] = (monotonic() + self.cache_ttl, result)
+                self.cache.move_to_end(ip)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        finally:
+            with self.reader_condition:
+                self.in_flight[reader] -= 1
+                if not self.in_flight[reader]:
+                    del self.in_flight[reader]
+                    self.reader_condition.notify_all()
+
+        return self.cached_result(result)
+
+    @staticmethod
+    def cached_result(result):
+        if isinstance(result, AddressNotFoundError):
+            raise result.with_traceback(None)
+        return result
+
+    def clear_cache(self):
+        with self.cache_lock:
+            self.cache.clear()
+        if self.cache_hits or self.cache_misses:
+            self.logger.debug('GeoIP lookup cache cleared after %s hits and %s misses',
+                              self.cache_hits, self.cache_misses)
 
     def update(self):
         today = date.today()
@@ -66,9 +176,10 @@ class GeoIPHandler(object):
             self.logger.info("Newer MaxMind DB available, Updating...")
             self.logger.debug("MaxMind DB date %s, DB updates after: %s, Today: %s",
                               dbdate, db_next_update, today)
-            self.reader_manager(action='close')
-            self.download()
-            self.reader_manager(action='open')
+            # Lookups keep using the current database until the new one is downloaded and verified
+            result_status = self.download()
+            if result_status is None:
+                self.swap_reader()
         else:
             db_days_update = db_next_update - today
             self.logger.debug("MaxMind DB will update in %s days", abs(db_days_update.days))
@@ -76,24 +187,31 @@ class GeoIPHandler(object):
                               dbdate, db_next_update, today)
 
     def download(self):
-        tar_dbfile = abspath(join(self.data_folder, 'GeoLite2-City.tar.gz'))
-        maxmind_url = ('https://download.maxmind.com/app/geoip_download?edition_id=GeoLite2-City'
-                       f'&suffix=tar.gz&license_key={self.maxmind_license_key}')
-        downloaded = False
+        """
+        Stream the GeoLite2 tarball and extract only the mmdb member, without writing the tarball to disk.
+        Returns 1 if it failed and 0 if MaxMind has nothing newer than the database we already have.
+        """
+        maxmind_url = self.download_url.format(license_key=self.maxmind_license_key)
+        request = URLRequest(maxmind_url)
+        try:
+            request.add_header('If-Modified-Since', formatdate(stat(self.dbfile).st_mtime, usegmt=True))
+        except FileNotFoundError:
+            pass
 
         retry_counter = 0
 
-        while not downloaded:
+        while True:
             self.logger.info('Downloading GeoLite2 DB from MaxMind...')
             try:
-                urlretrieve(maxmind_url, tar_dbfile)
-                downloaded = True
-            except URLError as e:
-                self.logger.error("Problem downloading new MaxMind DB: %s", e)
-                result_status = 1
-                return result_status
+                with urlopen(request, timeout=60) as response:
+                    return self.extract(response)
             except HTTPError as e:
-                if e.code == 401:
+                if e.code == 304:
+                    self.logger.info('MaxMind DB is already up to date')
+                    # Restart the wait until the next update check
+                    utime(self.dbfile)
+                    return 0
+                elif e.code == 401:
                     self.logger.error("Your MaxMind license key is incorect! Check your config: %s", e)
                     result_status = 1
                     return result_status
@@ -106,27 +224,90 @@ class GeoIPHandler(object):
                     self.logger.error("Retried downloading the new MaxMind DB 3 times and failed... Aborting!")
                     result_status = 1
                     return result_status
-        try:
-            remove(self.dbfile)
-        except FileNotFoundError:
-            self.logger.warning("Cannot remove MaxMind DB as it does not exist!")
-
-        self.logger.debug("Opening MaxMind tar file : %s", tar_dbfile)
-
-        tar = taropen(tar_dbfile, 'r:gz')
+            except (URLError, OSError, TarError, EOFError) as e:
+                self.logger.error("Problem downloading new MaxMind DB: %s", e)
+                result_status = 1
+                return result_status
 
-        for files in tar.getmembers():
-            if 'GeoLite2-City.mmdb' in files.name:
-                self.logger.debug('"GeoLite2-City.mmdb" FOUND in tar file')
-                files.name = basename(files.name)
-                tar.extract(files, self.data_folder)
-                self.logger.debug('%s has been extracted to %s', files, self.data_folder)
-        tar.close()
+    def extract(self, fileobj):
+        tmp_dbfile = f'{self.dbfile}.tmp'
+        # 'r|gz' reads the stream front to back, so members after the mmdb are never downloaded
+        with taropen(fileobj=fileobj, mode='r|gz') as tar:
+            for files in tar:
+                if files.isfile() and files.name.endswith('GeoLite2-City.mmdb'):
+                    self.logger.debug('"GeoLite2-City.mmdb" FOUND in tar file')
+                    with tar.extractfile(files) as source, open(tmp_dbfile, 'wb') as target:
+                        copyfileobj(source, target)
+                    self.logger.debug('%s has been extracted to %s', files, tmp_dbfile)
+                    return self.install(tmp_dbfile)
+
+        self.logger.error('Could not find GeoLite2-City.mmdb in the downloaded MaxMind tar file')
+        return 1
+
+    def install(self, tmp_dbfile):
+        """Check that a freshly extracted database opens before moving it over the one in use"""
         try:
-            remove(tar_dbfile)
-            self.logger.debug('Removed the MaxMind DB tar file.')
-        except FileNotFoundError:
-            self.logger.warning("Cannot remove MaxMind DB TAR file as it does not exist!")
+            with Reader(tmp_dbfile) as reader:
+                database_type = reader.metadata().database_type
+            if 'City' not in database_type:
+                raise ValueError(f'expected a City database, got {database_type}')
+        except Exception as e:
+            self.logger.error('Downloaded MaxMind DB is not usable, keeping the current one: %s', e)
+            try:
+                remove(tmp_dbfile)
+            except FileNotFoundError:
+                pass
+            return 1
+
+        replace(tmp_dbfile, self.dbfile)
+        self.logger.info('Installed new MaxMind DB (%s)', database_type)
+
+
+class CircuitBreaker(object):
+    """
+    Stops polling a backend for a cool-down period after it failed several times in a row
+    """
+    threshold = 5
+    cooldown = 300
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened = None
+        self.lock = Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if monotonic() - self.opened >= self.cooldown:
+                # Half open. Let a single request through to probe the backend
+                self.opened = monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            if self.opened is not None:
+                logger.info('%s is reachable again. Resuming requests.', self.host)
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened is None:
+                self.opened = monotonic()
+                logger.warning('%s failed %s times in a row. Pausing requests to it for %s seconds.',
+                               self.host, self.failures, self.cooldown)
+
+
+def circuit_breaker(url):
+    host = urlsplit(url).netloc
+    with circuit_breakers_lock:
+        if host not in circuit_breakers:
+            circuit_breakers[host] = CircuitBreaker(host)
+        return circuit_breakers[host]
 
 
 def hashit(string):
@@ -142,45 +323,236 @@ def rfc1918_ip_check(ip):
     return rfc1918_ip
 
 
-def connection_handler(session, request, verify, as_is_reply=False):
+def send_request(session, request, verify, timeout, stream=False):
+    if async_engine is not None:
+        return async_engine.send(session, request, verify=verify, timeout=timeout, stream=stream)
+    return session.send(request, verify=verify, timeout=timeout, stream=stream)
+
+
+def iter_json_array(chunks, fields=None):
+    """
+    Yield the elements of the top level JSON array in an iterable of byte chunks one at a time, so that only a
+    single element is ever decoded in memory. With fields, dict elements are cut down to just those keys.
+    """
+    decoder = JSONDecoder()
+    text = getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    started = False
+    done = False
+
+    def skip(buffer, pos):
+        while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+            pos += 1
+        return pos
+
+    for chunk in chunks:
+        buffer = buffer[pos:] + text.decode(chunk)
+        pos = skip(buffer, 0)
+        if not started and pos < len(buffer):
+            if buffer[pos] != '[':
+                raise JSONDecodeError('Expecting a JSON array', buffer, pos)
+            started = True
+            pos = skip(buffer, pos + 1)
+        while started and not done and pos < len(buffer):
+            if buffer[pos] == ']':
+                done = True
+                break
+            if buffer[pos] == ',':
+                pos = skip(buffer, pos + 1)
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except JSONDecodeError:
+                # The element continues in the next chunk
+                break
+            # A number cut off at the end of the buffer would decode fine, or stop short of a trailing '.' or
+            # exponent, so wait for what follows it
+            if (isinstance(element, (int, float)) and not isinstance(element, bool)
+                    and not buffer[end:].lstrip('0123456789.eE+-')):
+                break
+            end = skip(buffer, end)
+            if end == len(buffer):
+                break
+            if buffer[end] not in ',]':
+                raise JSONDecodeError("Expecting ',' delimiter", buffer, end)
+            pos = end
+            if fields is not None and isinstance(element, dict):
+                element = {field: element[field] for field in fields if field in element}
+            yield element
+        if done:
+            return
+
+    raise JSONDecodeError('Unterminated JSON array', buffer, pos)
+
+
+def connection_handler(session, request, verify, as_is_reply=False, timeout=DEFAULT_TIMEOUT, projection=None):
+    """
+    Send request and return its decoded JSON, or False on any error. With a projection the response must be a
+    JSON array, it is parsed as it downloads and only the projection's fields of each element are kept.
+    """
     air = as_is_reply
     s = session
     r = request
     v = verify
     return_json = False
+    stream = projection is not None
 
     disable_warnings(InsecureRequestWarning)
 
-    try:
-        get = s.send(r, verify=v)
-        if get.status_code == 401:
-            if 'NoSiteContext' in str(get.content):
-                logger.info('Your Site is incorrect for %s', r.url)
-            elif 'LoginRequired' in str(get.content):
-                logger.info('Your login credentials are incorrect for %s', r.url)
-            else:
-                logger.info('Your api key is incorrect for %s', r.url)
-        elif get.status_code == 404:
-            logger.info('This url doesnt even resolve: %s', r.url)
-        elif get.status_code == 200:
-            try:
-                return_json = get.json()
-            except JSONDecodeError:
-                logger.error('No JSON response. Response is: %s', get.text)
-        if air:
-            return get
-    except InvalidSchema:
-        logger.error("You added http(s):// in the config file. Don't do that.")
-    except SSLError as e:
-        logger.error('Either your host is unreachable or you have an SSL issue. : %s', e)
-    except ConnectionError as e:
-        logger.error('Cannot resolve the url/ip/port. Check connectivity. Error: %s', e)
-    except ChunkedEncodingError as e:
-        logger.error('Broken connection during request... oops? Error: %s', e)
+    breaker = circuit_breaker(r.url)
+    if not breaker.allow():
+        logger.debug('Circuit breaker for %s is open. Skipping request.', breaker.host)
+        return return_json
+
+    # Only idempotent GETs are retried
+    attempts = RETRIES + 1 if r.method == 'GET' else 1
+    get = None
+    error = None
+    for attempt in range(attempts):
+        if attempt:
+            logger.debug('Retrying request to %s (%s/%s)', breaker.host, attempt, RETRIES)
+            sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        try:
+            get = send_request(s, r, v, timeout, stream=stream)
+            error = None
+        except (InvalidSchema, SSLError) as e:
+            error = e
+            break
+        except (ConnectionError, Timeout, ChunkedEncodingError) as e:
+            error = e
+        else:
+            if get.status_code not in RETRY_STATUSES:
+                break
+            get.close()
+
+    if error is not None:
+        if isinstance(error, InvalidSchema):
+            logger.error("You added http(s):// in the config file. Don't do that.")
+            return return_json
+        breaker.failure()
+        if isinstance(error, SSLError):
+            logger.error('Either your host is unreachable or you have an SSL issue. : %s', error)
+        elif isinstance(error, Timeout):
+            logger.error('Request timed out after %s retries. Error: %s', RETRIES, error)
+        elif isinstance(error, ConnectionError):
+            logger.error('Cannot resolve the url/ip/port. Check connectivity. Error: %s', error)
+        else:
+            logger.error('Broken connection during request... oops? Error: %s', error)
+        return return_json
+
+    if get.status_code >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+
+    if get.status_code == 401:
+        if 'NoSiteContext' in str(get.content):
+            logger.info('Your Site is incorrect for %s', r.url)
+        elif 'LoginRequired' in str(get.content):
+            logger.info('Your login credentials are incorrect for %s', r.url)
+        else:
+            logger.info('Your api key is incorrect for %s', r.url)
+    elif get.status_code == 404:
+        logger.info('This url doesnt even resolve: %s', r.url)
+    elif get.status_code >= 500:
+        logger.error('Server error %s for %s', get.status_code, r.url)
+    elif get.status_code == 200 and stream:
+        try:
+            return_json = list(iter_json_array(get.iter_content(STREAM_CHUNK_SIZE), projection))
+        except JSONDecodeError as e:
+            logger.error('No JSON array in response from %s. Error: %s', r.url, e)
+        finally:
+            get.close()
+    elif get.status_code == 200:
+        try:
+            return_json = jsonbackend.loads(get.content)
+        except jsonbackend.DecodeErrors:
+            logger.error('No JSON response. Response is: %s', get.text)
+    if stream:
+        # Error replies to a streamed request are never read to the end, give their connection back
+        get.close()
+    if air:
+        return get
 
     return return_json
 
 
+def fetch_pages(session, url, params, verify, timeout=DEFAULT_TIMEOUT):
+    """
+    Return the records of every page of a paged *arr endpoint, or False if any page failed. Once the first
+    page reveals totalRecords the remaining pages are fetched concurrently and merged back in page order.
+    """
+    def get_page(page):
+        req = session.prepare_request(Request('GET', url, params=dict(params, page=page)))
+        return connection_handler(session, req, verify, timeout=timeout)
+
+    get = get_page(1)
+    if not get:
+        return False
+
+    response = QueuePages(**get)
+    last_page = -(-int(response.totalRecords) // response.pageSize)
+    pages = [response]
+    if last_page > 1:
+        for get in shared_page_pool().map(get_page, range(2, last_page + 1)):
+            if not get:
+                return False
+            pages.append(QueuePages(**get))
+
+    # Items that move between pages while they are fetched would otherwise show up twice. Records without
+    # an id cannot be told apart, so they are all kept
+    records = []
+    seen = set()
+    for page in pages:
+        for record in page.records:
+            record_id = record.get('id')
+            if record_id is None or record_id not in seen:
+                seen.add(record_id)
+                records.append(record)
+    return records
+
+
+def shared_page_pool():
+    global page_pool
+    with page_pool_lock:
+        if page_pool is None:
+            page_pool = ThreadPoolExecutor(max_workers=PAGE_WORKERS, thread_name_prefix='varken-pages')
+        return page_pool
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls made from any number of threads so that no more than `rate` start per second
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = monotonic()
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            delay = self.next_call - now
+            self.next_call = max(self.next_call, now) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+def bounded_map(function, iterable, workers):
+    """
+    Like ThreadPoolExecutor.map, but only keeps a couple of calls per worker in flight so that a long or
+    lazily generated iterable is consumed as results are used instead of all at once. Results keep input order.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def mkdir_p(path):
     templogger = getLogger('temp')
     try:
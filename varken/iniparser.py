@@ -6,8 +6,8 @@ from os.path import join, exists
 from re import match, compile, IGNORECASE
 from configparser import ConfigParser, NoOptionError, NoSectionError
 
-from varken.varkenlogger import BlacklistFilter
-from varken.structures import SickChillServer, UniFiServer
+from varken.varkenlogger import BlacklistFilter, log_handlers
+from varken.structures import SickChillServer, UniFiServer, WebhookServer
 from varken.helpers import clean_sid_check, rfc1918_ip_check, boolcheck
 from varken.structures import SonarrServer, RadarrServer, OmbiServer, OverseerrServer, TautulliServer, InfluxServer
 
@@ -39,8 +39,15 @@ class INIParser(object):
         without_port = [string.split(':')[0] for string in filtered_strings if ':' in string]
         self.filtered_strings.extend(without_port)
 
-        for handler in self.logger.handlers:
-            handler.addFilter(BlacklistFilter(set(self.filtered_strings)))
+        # One filter, and one compiled pattern, shared by every handler. With async logging these are the
+        # handlers of the queue listener, so redaction runs on the listener thread
+        handlers = log_handlers(self.logger)
+        blacklist_filter = BlacklistFilter(set(self.filtered_strings),
+                                           level=min((handler.level for handler in handlers), default=0))
+        for handler in handlers:
+            for old_filter in [f for f in handler.filters if isinstance(f, BlacklistFilter)]:
+                handler.removeFilter(old_filter)
+            handler.addFilter(blacklist_filter)
 
     def enable_check(self, server_type=None):
         t = server_type
@@ -154,13 +161,67 @@ class INIParser(object):
 
             username = env.get('VRKN_INFLUXDB_USERNAME', self.config.get('influxdb', 'username'))
             password = env.get('VRKN_INFLUXDB_PASSWORD', self.config.get('influxdb', 'password'))
+
+            buffered_writes = boolcheck(env.get('VRKN_INFLUXDB_BUFFERED_WRITES',
+                                                self.config.get('influxdb', 'buffered_writes', fallback='false')))
+            batch_size = int(env.get('VRKN_INFLUXDB_BATCH_SIZE',
+                                     self.config.getint('influxdb', 'batch_size', fallback=5000)))
+            flush_interval = float(env.get('VRKN_INFLUXDB_FLUSH_INTERVAL',
+                                           self.config.getfloat('influxdb', 'flush_interval', fallback=1.0)))
+
+            spool = boolcheck(env.get('VRKN_INFLUXDB_SPOOL', self.config.get('influxdb', 'spool', fallback='true')))
+            spool_max_mb = int(env.get('VRKN_INFLUXDB_SPOOL_MAX_MB',
+                                       self.config.getint('influxdb', 'spool_max_mb', fallback=100)))
+            spool_replay_rate = int(env.get('VRKN_INFLUXDB_SPOOL_REPLAY_RATE',
+                                            self.config.getint('influxdb', 'spool_replay_rate', fallback=5000)))
+
+            payload_log_sample = float(env.get('VRKN_INFLUXDB_PAYLOAD_LOG_SAMPLE',
+                                               self.config.getfloat('influxdb', 'payload_log_sample', fallback=0.0)))
+            payload_log_max_chars = int(env.get('VRKN_INFLUXDB_PAYLOAD_LOG_MAX_CHARS',
+                                                self.config.getint('influxdb', 'payload_log_max_chars',
+                                                                   fallback=2000)))
         except NoOptionError as e:
             self.logger.error('Missing key in %s. Error: %s', "influxdb", e)
             self.rectify_ini()
             return
 
+        # Parse scheduler options
+        try:
+            self.max_workers = int(env.get('VRKN_GLOBAL_MAX_WORKERS',
+                                           self.config.getint('global', 'max_workers', fallback=10)))
+            self.max_queued_jobs = int(env.get('VRKN_GLOBAL_MAX_QUEUED_JOBS',
+                                               self.config.getint('global', 'max_queued_jobs', fallback=100)))
+            self.engine = env.get('VRKN_GLOBAL_ENGINE', self.config.get('global', 'engine', fallback='threads')).lower()
+            self.max_connections = int(env.get('VRKN_GLOBAL_MAX_CONNECTIONS',
+                                               self.config.getint('global', 'max_connections', fallback=100)))
+            self.json_backend = env.get('VRKN_GLOBAL_JSON_BACKEND',
+                                        self.config.get('global', 'json_backend', fallback='auto')).lower()
+        except ValueError as e:
+            self.logger.error("Invalid configuration value in global. Error: %s", e)
+            exit(1)
+
+        # Parse webhook listener options
+        try:
+            self.webhook_server = WebhookServer(
+                enabled=boolcheck(env.get('VRKN_WEBHOOKS_ENABLED',
+                                          self.config.get('webhooks', 'enabled', fallback='false'))),
+                bind=env.get('VRKN_WEBHOOKS_BIND', self.config.get('webhooks', 'bind', fallback='0.0.0.0')),
+                port=int(env.get('VRKN_WEBHOOKS_PORT', self.config.getint('webhooks', 'port', fallback=8089))),
+                apikey=env.get('VRKN_WEBHOOKS_APIKEY', self.config.get('webhooks', 'apikey', fallback=None)))
+        except ValueError as e:
+            self.logger.error("Invalid configuration value in webhooks. Error: %s", e)
+            exit(1)
+
+        if self.engine not in ('threads', 'asyncio'):
+            self.logger.error('Invalid engine "%s" in global. Must be threads or asyncio. Using threads', self.engine)
+            self.engine = 'threads'
+
         self.influx_server = InfluxServer(url=url, port=port, username=username, password=password, ssl=ssl,
-                                          verify_ssl=verify_ssl)
+                                          verify_ssl=verify_ssl, buffered_writes=buffered_writes,
+                                          batch_size=batch_size, flush_interval=flush_interval, spool=spool,
+                                          spool_max_mb=spool_max_mb, spool_replay_rate=spool_replay_rate,
+                                          payload_log_sample=payload_log_sample,
+                                          payload_log_max_chars=payload_log_max_chars)
 
         # Check for all enabled services
         for service in self.services:
@@ -192,11 +253,27 @@ class INIParser(object):
                         if scheme != 'https://':
                             verify_ssl = False
 
+                        connect_timeout = float(env.get(f'VRKN_{envsection}_CONNECT_TIMEOUT',
+                                                        self.config.getfloat(section, 'connect_timeout', fallback=5)))
+                        read_timeout = float(env.get(f'VRKN_{envsection}_READ_TIMEOUT',
+                                                     self.config.getfloat(section, 'read_timeout', fallback=30)))
+                        timeout = (connect_timeout, read_timeout)
+
+                        if service in ['sonarr', 'radarr', 'lidarr', 'sickchill']:
+                            change_detection = boolcheck(env.get(
+                                f'VRKN_{envsection}_CHANGE_DETECTION',
+                                self.config.get(section, 'change_detection', fallback='false')))
+                            full_refresh_seconds = int(env.get(
+                                f'VRKN_{envsection}_FULL_REFRESH_SECONDS',
+                                self.config.getint(section, 'full_refresh_seconds', fallback=3600)))
+
                         if service in ['sonarr', 'radarr', 'lidarr']:
                             queue = boolcheck(env.get(f'VRKN_{envsection}_QUEUE',
                                                       self.config.get(section, 'queue')))
                             queue_run_seconds = int(env.get(f'VRKN_{envsection}_QUEUE_RUN_SECONDS',
                                                     self.config.getint(section, 'queue_run_seconds')))
+                            columnar = boolcheck(env.get(f'VRKN_{envsection}_COLUMNAR',
+                                                         self.config.get(section, 'columnar', fallback='false')))
 
                         if service in ['sonarr', 'lidarr']:
                             missing_days = int(env.get(f'VRKN_{envsection}_MISSING_DAYS',
@@ -216,7 +293,9 @@ class INIParser(object):
                                                   missing_days=missing_days, future_days=future_days,
                                                   missing_days_run_seconds=missing_days_run_seconds,
                                                   future_days_run_seconds=future_days_run_seconds,
-                                                  queue=queue, queue_run_seconds=queue_run_seconds)
+                                                  queue=queue, queue_run_seconds=queue_run_seconds, timeout=timeout,
+                                                  change_detection=change_detection,
+                                                  full_refresh_seconds=full_refresh_seconds, columnar=columnar)
 
                         if service == 'radarr':
                             get_missing = boolcheck(env.get(f'VRKN_{envsection}_GET_MISSING',
@@ -227,7 +306,9 @@ class INIParser(object):
 
                             server = RadarrServer(id=server_id, url=scheme + url, api_key=apikey, verify_ssl=verify_ssl,
                                                   queue_run_seconds=queue_run_seconds, get_missing=get_missing,
-                                                  queue=queue, get_missing_run_seconds=get_missing_run_seconds)
+                                                  queue=queue, get_missing_run_seconds=get_missing_run_seconds,
+                                                  timeout=timeout, change_detection=change_detection,
+                                                  full_refresh_seconds=full_refresh_seconds, columnar=columnar)
 
                         if service == 'tautulli':
                             fallback_ip = env.get(f'VRKN_{envsection}_FALLBACK_IP',
@@ -262,7 +343,7 @@ class INIParser(object):
                                                     fallback_ip=fallback_ip, get_stats=get_stats,
                                                     get_activity_run_seconds=get_activity_run_seconds,
                                                     get_stats_run_seconds=get_stats_run_seconds,
-                                                    maxmind_license_key=maxmind_license_key)
+                                                    maxmind_license_key=maxmind_license_key, timeout=timeout)
 
                         if service == 'ombi':
                             issue_status_counts = boolcheck(env.get(
@@ -291,7 +372,7 @@ class INIParser(object):
                                                 request_total_counts=request_total_counts,
                                                 request_total_run_seconds=request_total_run_seconds,
                                                 issue_status_counts=issue_status_counts,
-                                                issue_status_run_seconds=issue_status_run_seconds)
+                                                issue_status_run_seconds=issue_status_run_seconds, timeout=timeout)
 
                         if service == 'overseerr':
                             get_request_total_counts = boolcheck(env.get(
@@ -316,7 +397,7 @@ class INIParser(object):
                                                      request_total_run_seconds=request_total_run_seconds,
                                                      num_latest_requests_to_fetch=num_latest_requests_to_fetch,
                                                      num_latest_requests_seconds=num_latest_requests_seconds,
-                                                     num_total_issue_counts=num_total_issue_counts)
+                                                     num_total_issue_counts=num_total_issue_counts, timeout=timeout)
 
                         if service == 'sickchill':
                             get_missing = boolcheck(env.get(f'VRKN_{envsection}_GET_MISSING',
@@ -327,7 +408,9 @@ class INIParser(object):
 
                             server = SickChillServer(id=server_id, url=scheme + url, api_key=apikey,
                                                      verify_ssl=verify_ssl, get_missing=get_missing,
-                                                     get_missing_run_seconds=get_missing_run_seconds)
+                                                     get_missing_run_seconds=get_missing_run_seconds, timeout=timeout,
+                                                     change_detection=change_detection,
+                                                     full_refresh_seconds=full_refresh_seconds)
 
                         if service == 'unifi':
                             username = env.get(f'VRKN_{envsection}_USERNAME', self.config.get(section, 'username'))
@@ -340,7 +423,7 @@ class INIParser(object):
 
                             server = UniFiServer(id=server_id, url=scheme + url, verify_ssl=verify_ssl, site=site,
                                                  username=username, password=password, usg_name=usg_name,
-                                                 get_usg_stats_run_seconds=get_usg_stats_run_seconds)
+                                                 get_usg_stats_run_seconds=get_usg_stats_run_seconds, timeout=timeout)
 
                         getattr(self, f'{service}_servers').append(server)
                     except NoOptionError as e:
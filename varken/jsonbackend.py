@@ -0,0 +1,78 @@
+import json
+from logging import getLogger
+
+logger = getLogger()
+
+
+def orjson_backend():
+    import orjson
+    return orjson.loads, (orjson.JSONDecodeError,)
+
+
+def msgspec_backend():
+    import msgspec
+    return msgspec.json.decode, (msgspec.DecodeError,)
+
+
+def ujson_backend():
+    import ujson
+    return ujson.loads, (ValueError,)
+
+
+def stdlib_backend():
+    return json.loads, (json.JSONDecodeError,)
+
+
+# In order of preference, the first one installed is used
+BACKENDS = {
+    'orjson': orjson_backend,
+    'msgspec': msgspec_backend,
+    'ujson': ujson_backend,
+    'json': stdlib_backend,
+}
+
+name = None
+loads = json.loads
+# Exceptions the current backend raises on invalid JSON
+DecodeErrors = (json.JSONDecodeError,)
+
+
+def available():
+    """Return the names of the backends that can be imported, in order of preference"""
+    names = []
+    for backend_name, backend in BACKENDS.items():
+        try:
+            backend()
+        except ImportError:
+            continue
+        names.append(backend_name)
+    return names
+
+
+def use(backend_name=None):
+    """
+    Decode JSON with backend_name from now on, or with the fastest installed backend when it is None, 'auto'
+    or not installed. Returns the name of the backend in use.
+    """
+    global name, loads, DecodeErrors
+
+    candidates = list(BACKENDS)
+    if backend_name and backend_name != 'auto':
+        if backend_name not in BACKENDS:
+            logger.error('Unknown JSON backend %s. Choose from %s', backend_name, ', '.join(BACKENDS))
+        else:
+            candidates.insert(0, backend_name)
+
+    for candidate in candidates:
+        try:
+            loads, DecodeErrors = BACKENDS[candidate]()
+        except ImportError:
+            if candidate == backend_name:
+                logger.error('JSON backend %s is not installed', backend_name)
+            continue
+        name = candidate
+        break
+    return name
+
+
+use()
@@ -3,17 +3,26 @@ from requests import Session, Request
 from datetime import datetime, timezone, date, timedelta
 
 from varken.structures import LidarrQueue, LidarrAlbum
-from varken.helpers import hashit, connection_handler
+from varken.helpers import hashit, connection_handler, fetch_pages
+from varken.lineprotocol import LineProtocol
+from varken.changes import ChangeDetector
+from varken.decoder import StructDecoder
 
 
 class LidarrAPI(object):
-    def __init__(self, server, dbmanager):
+    album_decoder = StructDecoder(LidarrAlbum)
+    queue_decoder = StructDecoder(LidarrQueue)
+
+    def __init__(self, server, dbmanager, statestore=None):
         self.dbmanager = dbmanager
         self.server = server
         # Create session to reduce server web thread load, and globally define pageSize for all requests
         self.session = Session()
         self.session.headers = {'X-Api-Key': self.server.api_key}
         self.logger = getLogger()
+        self.change_detector = None
+        if self.server.change_detection:
+            self.change_detector = ChangeDetector(self.server.full_refresh_seconds, statestore)
 
     def __repr__(self):
         return f"<lidarr-{self.server.id}>"
@@ -28,23 +37,17 @@ class LidarrAPI(object):
             params = {'start': last_days, 'end': today}
         else:
             params = {'start': today, 'end': future}
-        influx_payload = []
+        influx_payload = LineProtocol('Lidarr', now)
         influx_albums = []
 
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get:
             return
 
         # Iteratively create a list of LidarrAlbum Objects from response json
-        albums = []
-        for album in get:
-            try:
-                albums.append(LidarrAlbum(**album))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating LidarrAlbum structure for album. Data '
-                                  'attempted is: %s', e, album)
+        albums = self.album_decoder.decode_all(get)
 
         # Add Album to missing list if album is not complete
         for album in albums:
@@ -57,48 +60,42 @@ class LidarrAPI(object):
 
         for title, release_date, artist_name, album_id, percent_complete, complete_count in influx_albums:
             hash_id = hashit(f'{self.server.id}{title}{album_id}')
-            influx_payload.append(
-                {
-                    "measurement": "Lidarr",
-                    "tags": {
-                        "type": query,
-                        "sonarrId": album_id,
-                        "server": self.server.id,
-                        "albumName": title,
-                        "artistName": artist_name,
-                        "percentComplete": percent_complete,
-                        "completeCount": complete_count,
-                        "releaseDate": release_date
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-
-                    }
+            influx_payload.add(
+                tags={
+                    "type": query,
+                    "sonarrId": album_id,
+                    "server": self.server.id,
+                    "albumName": title,
+                    "artistName": artist_name,
+                    "percentComplete": percent_complete,
+                    "completeCount": complete_count,
+                    "releaseDate": release_date
+                },
+                fields={
+                    "hash": hash_id
+
                 }
             )
 
-        self.dbmanager.write_points(influx_payload)
+        lines = influx_payload.lines
+        if self.change_detector:
+            lines = self.change_detector.changes(f'lidarr-{self.server.id}-calendar-{query}', influx_payload)
+        if lines:
+            self.dbmanager.write_points(lines)
 
     def get_queue(self):
         endpoint = '/api/v1/queue'
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        influx_payload = []
+        influx_payload = LineProtocol('Lidarr', now)
         params = {'pageSize': 1000}
 
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        records = fetch_pages(self.session, self.server.url + endpoint, params, self.server.verify_ssl,
+                              timeout=self.server.timeout)
 
-        if not get:
+        if not records:
             return
 
-        queue = []
-        for song in get['records']:
-            try:
-                queue.append(LidarrQueue(**song))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating LidarrQueue structure for show. Data '
-                                  'attempted is: %s', e, song)
+        queue = self.queue_decoder.decode_all(records)
 
         if not queue:
             return
@@ -109,24 +106,20 @@ class LidarrAPI(object):
             else:
                 protocol_id = 0
             hash_id = hashit(f'{self.server.id}{song.title}{song.artistId}')
-            influx_payload.append(
-                {
-                    "measurement": "Lidarr",
-                    "tags": {
-                        "type": "Queue",
-                        "id": song.id,
-                        "server": self.server.id,
-                        "title": song.title,
-                        "quality": song.quality['quality']['name'],
-                        "protocol": song.protocol,
-                        "protocol_id": protocol_id,
-                        "indexer": song.indexer
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-                    }
+            influx_payload.add(
+                tags={
+                    "type": "Queue",
+                    "id": song.id,
+                    "server": self.server.id,
+                    "title": song.title,
+                    "quality": song.quality['quality']['name'],
+                    "protocol": song.protocol,
+                    "protocol_id": protocol_id,
+                    "indexer": song.indexer
+                },
+                fields={
+                    "hash": hash_id
                 }
             )
 
-        self.dbmanager.write_points(influx_payload)
+        self.dbmanager.write_points(influx_payload.lines)
@@ -0,0 +1,151 @@
+from math import isfinite
+from itertools import repeat
+from functools import lru_cache
+from datetime import datetime, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+ESCAPE_KEY = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+ESCAPE_STRING = str.maketrans({'"': r'\"', '\\': r'\\'})
+
+
+@lru_cache(maxsize=1024)
+def escape_measurement(measurement):
+    return str(measurement).translate(ESCAPE_MEASUREMENT)
+
+
+@lru_cache(maxsize=1024)
+def escape_key(key):
+    return str(key).translate(ESCAPE_KEY)
+
+
+def escape_tag_value(value):
+    escaped = str(value).translate(ESCAPE_KEY)
+    if escaped.endswith('\\'):
+        escaped += ' '
+    return escaped
+
+
+def encode_field(value):
+    # Check bool before int as bool is a subclass of int
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f'{value}i'
+    if isinstance(value, float):
+        if not isfinite(value):
+            return None
+        encoded = str(value)
+        return encoded[:-2] if encoded.endswith('.0') else encoded
+    if isinstance(value, str):
+        return '"' + value.translate(ESCAPE_STRING) + '"'
+    raise ValueError(f'Type: "{type(value)}" of field value "{value}" is not supported.')
+
+
+def timestamp(time):
+    """Convert a datetime, an ISO 8601 string or an epoch in nanoseconds to nanoseconds"""
+    if time is None or isinstance(time, int):
+        return time
+    if isinstance(time, str):
+        time = datetime.fromisoformat(time)
+    if time.tzinfo is None:
+        time = time.astimezone()
+    delta = time - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
+
+class LineProtocol(object):
+    """
+    Encodes points of a single measurement straight to line protocol, skipping the intermediate
+    point dicts. Produces the same output as influxdb_client's Point for the same tags and fields.
+    """
+    def __init__(self, measurement, time=None):
+        self.measurement = escape_measurement(measurement)
+        self.time = self.encode_time(time)
+        self.lines = []
+
+    def __len__(self):
+        return len(self.lines)
+
+    @staticmethod
+    def encode_time(time):
+        ns = timestamp(time)
+        return '' if ns is None else f' {ns}'
+
+    def add(self, tags, fields, time=None):
+        encoded_fields = []
+        for key, value in sorted(fields.items()):
+            if value is None:
+                continue
+            value = encode_field(value)
+            if value is not None:
+                encoded_fields.append(f'{escape_key(key)}={value}')
+        if not encoded_fields:
+            return
+
+        encoded_tags = ''.join(f',{escape_key(key)}={value}' for key, value in
+                               ((key, escape_tag_value(value)) for key, value in sorted(tags.items())
+                                if value is not None) if value)
+
+        encoded_time = self.time if time is None else self.encode_time(time)
+        self.lines.append(f'{self.measurement}{encoded_tags} {",".join(encoded_fields)}{encoded_time}'.encode())
+
+    def add_columns(self, tags, fields, count):
+        """
+        Add count points at once. Each tag and field is either a list holding one value per point, or a single value
+        shared by every point. Every column is encoded in one pass, giving the same lines as calling add per point.
+        """
+        tag_columns = []
+        for key, values in sorted(tags.items()):
+            prefix = f',{escape_key(key)}='
+            if isinstance(values, (list, tuple)):
+                tag_columns.append(self.tag_column(prefix, values))
+            else:
+                tag_columns.append(repeat(self.tag_part(prefix, values), count))
+
+        field_columns = []
+        for key, values in sorted(fields.items()):
+            prefix = f'{escape_key(key)}='
+            if isinstance(values, (list, tuple)):
+                field_columns.append([self.field_part(prefix, value) for value in values])
+            else:
+                field_columns.append(repeat(self.field_part(prefix, values), count))
+
+        start = self.measurement
+        end = self.time
+        for encoded_tags, encoded_fields in zip(zip(*tag_columns) if tag_columns else repeat((), count),
+                                                zip(*field_columns)):
+            encoded_fields = ','.join(field for field in encoded_fields if field)
+            if encoded_fields:
+                self.lines.append(f'{start}{"".join(encoded_tags)} {encoded_fields}{end}'.encode())
+
+    @staticmethod
+    def tag_column(prefix, values):
+        # Escape the whole column with a single translate, splitting it back on a separator no tag value has
+        strings = ['' if value is None else str(value) for value in values]
+        joined = '\0'.join(strings)
+        if joined.count('\0') != len(strings) - 1:
+            return [LineProtocol.tag_part(prefix, value) for value in values]
+        escaped = joined.translate(ESCAPE_KEY).split('\0')
+        if '\\' in joined:
+            escaped = [value + ' ' if value.endswith('\\') else value for value in escaped]
+        return [prefix + value if value else '' for value in escaped]
+
+    @staticmethod
+    def tag_part(prefix, value):
+        if value is None:
+            return ''
+        value = escape_tag_value(value)
+        return prefix + value if value else ''
+
+    @staticmethod
+    def field_part(prefix, value):
+        if value is None:
+            return ''
+        value = encode_field(value)
+        return '' if value is None else prefix + value
+
+    def clear(self):
+        # Start a new list rather than emptying this one, a buffered writer may still hold a reference to it
+        self.lines = []
@@ -4,9 +4,13 @@ from datetime import datetime, timezone
 
 from varken.helpers import connection_handler, hashit
 from varken.structures import OmbiRequestCounts, OmbiIssuesCounts, OmbiMovieRequest, OmbiTVRequest
+from varken.decoder import StructDecoder
 
 
 class OmbiAPI(object):
+    tv_request_decoder = StructDecoder(OmbiTVRequest)
+    movie_request_decoder = StructDecoder(OmbiMovieRequest)
+
     def __init__(self, server, dbmanager):
         self.dbmanager = dbmanager
         self.server = server
@@ -25,8 +29,9 @@ class OmbiAPI(object):
 
         tv_req = self.session.prepare_request(Request('GET', self.server.url + tv_endpoint))
         movie_req = self.session.prepare_request(Request('GET', self.server.url + movie_endpoint))
-        get_tv = connection_handler(self.session, tv_req, self.server.verify_ssl) or []
-        get_movie = connection_handler(self.session, movie_req, self.server.verify_ssl) or []
+        get_tv = connection_handler(self.session, tv_req, self.server.verify_ssl, timeout=self.server.timeout) or []
+        get_movie = connection_handler(self.session, movie_req, self.server.verify_ssl,
+                                       timeout=self.server.timeout) or []
 
         if not any([get_tv, get_movie]):
             self.logger.error('No json replies. Discarding job')
@@ -42,21 +47,8 @@ class OmbiAPI(object):
         else:
             tv_request_count = 0
 
-        tv_show_requests = []
-        for show in get_tv:
-            try:
-                tv_show_requests.append(OmbiTVRequest(**show))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating OmbiTVRequest structure for show. '
-                                  'data attempted is: %s', e, show)
-
-        movie_requests = []
-        for movie in get_movie:
-            try:
-                movie_requests.append(OmbiMovieRequest(**movie))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating OmbiMovieRequest structure for movie. '
-                                  'data attempted is: %s', e, movie)
+        tv_show_requests = self.tv_request_decoder.decode_all(get_tv)
+        movie_requests = self.movie_request_decoder.decode_all(get_movie)
 
         influx_payload = [
             {
@@ -154,7 +146,7 @@ class OmbiAPI(object):
         endpoint = '/api/v1/Request/count'
 
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get:
             return
@@ -182,7 +174,7 @@ class OmbiAPI(object):
         endpoint = '/api/v1/Issues/count'
 
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get:
             return
@@ -1,12 +1,17 @@
 from logging import getLogger
 from requests import Session, Request
+from time import monotonic
 from datetime import datetime, timezone
 
-from varken.helpers import connection_handler, hashit
+from varken.helpers import connection_handler, hashit, bounded_map
 from varken.structures import OverseerrRequestCounts, OverseerrIssuesCounts
 
 
 class OverseerrAPI(object):
+    # Media titles are looked up concurrently and cached for an hour, they rarely change
+    media_workers = 4
+    media_cache_ttl = 3600
+
     def __init__(self, server, dbmanager):
         self.dbmanager = dbmanager
         self.server = server
@@ -14,6 +19,7 @@ class OverseerrAPI(object):
         self.session = Session()
         self.session.headers = {'X-Api-Key': self.server.api_key}
         self.logger = getLogger()
+        self.media_cache = {}
 
     def __repr__(self):
         return f"<overseerr-{self.server.id}>"
@@ -23,7 +29,7 @@ class OverseerrAPI(object):
         endpoint = '/api/v1/request/count'
 
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get_req = connection_handler(self.session, req, self.server.verify_ssl)
+        get_req = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get_req:
             return
@@ -57,12 +63,10 @@ class OverseerrAPI(object):
     def get_latest_requests(self):
         now = datetime.now(timezone.utc).astimezone().isoformat()
         endpoint = '/api/v1/request?take=' + str(self.server.num_latest_requests_to_fetch) + '&filter=all&sort=added'
-        movie_endpoint = '/api/v1/movie/'
-        tv_endpoint = '/api/v1/tv/'
 
         # GET THE LATEST n REQUESTS
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get_latest_req = connection_handler(self.session, req, self.server.verify_ssl)
+        get_latest_req = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         # RETURN NOTHING IF NO RESULTS
         if not get_latest_req:
@@ -71,68 +75,68 @@ class OverseerrAPI(object):
 
         influx_payload = []
 
+        # Status, requester and date come with each request. Only the title needs a lookup, once per media
+        results = [result for result in get_latest_req['results'] if result['type'] in ('tv', 'movie')]
+        media = list(dict.fromkeys((result['type'], result['media']['tmdbId']) for result in results))
+        now_monotonic = monotonic()
+        self.media_cache = {key: value for key, value in self.media_cache.items() if value[0] > now_monotonic}
+        details = dict(zip(media, bounded_map(self.get_media_details, media, self.media_workers)))
+
         # Request Type: Movie = 1, TV Show = 0
-        for result in get_latest_req['results']:
-            if result['type'] == 'tv':
-                req = self.session.prepare_request(Request('GET',
-                                                           self.server.url +
-                                                           tv_endpoint +
-                                                           str(result['media']['tmdbId'])))
-                get_tv_req = connection_handler(self.session, req, self.server.verify_ssl)
-                hash_id = hashit(f'{get_tv_req["id"]}{get_tv_req["name"]}')
-
-                influx_payload.append(
-                    {
-                        "measurement": "Overseerr",
-                        "tags": {
-                            "type": "Requests",
-                            "server": self.server.id,
-                            "request_type": 0,
-                            "status": get_tv_req['mediaInfo']['status'],
-                            "title": get_tv_req['name'],
-                            "requested_user": get_tv_req['mediaInfo']['requests'][0]['requestedBy']['displayName'],
-                            "requested_date": get_tv_req['mediaInfo']['requests'][0]['createdAt']
-                        },
-                        "time": now,
-                        "fields": {
-                            "hash": hash_id
-                        }
+        for result in results:
+            detail = details[(result['type'], result['media']['tmdbId'])]
+            if not detail:
+                continue
+            media_id, title = detail
+            hash_id = hashit(f'{media_id}{title}')
+
+            influx_payload.append(
+                {
+                    "measurement": "Overseerr",
+                    "tags": {
+                        "type": "Requests",
+                        "server": self.server.id,
+                        "request_type": 0 if result['type'] == 'tv' else 1,
+                        "status": result['media']['status'],
+                        "title": title,
+                        "requested_user": result['requestedBy']['displayName'],
+                        "requested_date": result['createdAt']
+                    },
+                    "time": now,
+                    "fields": {
+                        "hash": hash_id
                     }
-                )
-
-            if result['type'] == 'movie':
-                req = self.session.prepare_request(Request('GET',
-                                                           self.server.url +
-                                                           movie_endpoint +
-                                                           str(result['media']['tmdbId'])))
-                get_movie_req = connection_handler(self.session, req, self.server.verify_ssl)
-                hash_id = hashit(f'{get_movie_req["id"]}{get_movie_req["title"]}')
-
-                influx_payload.append(
-                    {
-                        "measurement": "Overseerr",
-                        "tags": {
-                            "type": "Requests",
-                            "server": self.server.id,
-                            "request_type": 1,
-                            "status": get_movie_req['mediaInfo']['status'],
-                            "title": get_movie_req['title'],
-                            "requested_user": get_movie_req['mediaInfo']['requests'][0]['requestedBy']['displayName'],
-                            "requested_date": get_movie_req['mediaInfo']['requests'][0]['createdAt']
-                        },
-                        "time": now,
-                        "fields": {
-                            "hash": hash_id
-                        }
-                    }
-                )
+                }
+            )
+
+        if influx_payload:
+            self.dbmanager.write_points(influx_payload)
+        else:
+            self.logger.warning("No data to send to influx for overseerr-latest-requests instance, discarding.")
+
+    def get_media_details(self, media):
+        """Return the (id, title) of a movie or tv show, cached by tmdbId for media_cache_ttl seconds"""
+        cached = self.media_cache.get(media)
+        if cached and cached[0] > monotonic():
+            return cached[1]
+
+        media_type, tmdb_id = media
+        endpoint = f'/api/v1/tv/{tmdb_id}' if media_type == 'tv' else f'/api/v1/movie/{tmdb_id}'
+        req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
+        if not get:
+            return
+
+        detail = (get['id'], get['name'] if media_type == 'tv' else get['title'])
+        self.media_cache[media] = (monotonic() + self.media_cache_ttl, detail)
+        return detail
 
     def get_issue_counts(self):
         now = datetime.now(timezone.utc).astimezone().isoformat()
         endpoint = '/api/v1/issue/count'
 
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get:
             return
@@ -3,18 +3,30 @@ from logging import getLogger
 from requests import Session, Request
 from datetime import datetime, timezone
 
-from varken.structures import QueuePages, RadarrMovie, RadarrQueue
-from varken.helpers import hashit, connection_handler
+from varken.structures import RadarrMovie, RadarrQueue
+from varken.helpers import hashit, connection_handler, fetch_pages
+from varken.lineprotocol import LineProtocol
+from varken.changes import ChangeDetector
+from varken.decoder import StructDecoder
+from varken.columnar import ColumnBatch
 
 
 class RadarrAPI(object):
-    def __init__(self, server, dbmanager):
+    # Only the fields used below are read from each movie
+    movie_decoder = StructDecoder(RadarrMovie, fields=('monitored', 'hasFile', 'isAvailable', 'title', 'year',
+                                                       'tmdbId', 'titleSlug'), compact=True)
+    queue_decoder = StructDecoder(RadarrQueue)
+
+    def __init__(self, server, dbmanager, statestore=None):
         self.dbmanager = dbmanager
         self.server = server
         # Create session to reduce server web thread load, and globally define pageSize for all requests
         self.session = Session()
         self.session.headers = {'X-Api-Key': self.server.api_key}
         self.logger = getLogger()
+        self.change_detector = None
+        if self.server.change_detection:
+            self.change_detector = ChangeDetector(self.server.full_refresh_seconds, statestore)
 
     def __repr__(self):
         return f"<radarr-{self.server.id}>"
@@ -22,34 +34,32 @@ class RadarrAPI(object):
     def get_missing(self):
         endpoint = '/api/v3/movie'
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        influx_payload = []
-        missing = []
+        influx_payload = LineProtocol('Radarr', now)
 
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        # The movie list carries images, ratings and file details nothing here reads, keep just the used fields
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout,
+                                 projection=self.movie_decoder.projection)
 
         if not get:
             return
 
-        try:
-            # Filtrer les champs qui ne sont pas dans RadarrMovie
-            movies = []
-            for movie in get:
-                try:
-                    movie_data = {k: v for k, v in movie.items() if k in RadarrMovie._fields}
-                    movies.append(RadarrMovie(**movie_data))
-                except TypeError as e:
-                    self.logger.error('TypeError has occurred : %s while creating RadarrMovie structure for movie: %s', e, movie.get('title', 'Unknown'))
-                    # Log les champs problématiques pour debug
-                    problematic_fields = [k for k in movie.keys() if k not in RadarrMovie._fields]
-                    if problematic_fields:
-                        self.logger.debug('Champs non reconnus dans RadarrMovie: %s', problematic_fields)
-                        self.logger.debug('Champs disponibles dans RadarrMovie: %s', list(RadarrMovie._fields))
-                    continue
-        except Exception as e:
-            self.logger.error('Error processing Radarr movies: %s', e)
-            return
+        movies = self.movie_decoder.decode_all(get)
+        if self.server.columnar:
+            self.add_missing_columns(movies, influx_payload)
+        else:
+            self.add_missing(movies, influx_payload)
+
+        lines = influx_payload.lines
+        if self.change_detector:
+            lines = self.change_detector.changes(f'radarr-{self.server.id}-missing', influx_payload)
+        if lines:
+            self.dbmanager.write_points(lines)
+        elif not influx_payload:
+            self.logger.warning("No data to send to influx for radarr-missing instance, discarding.")
 
+    def add_missing(self, movies, influx_payload):
+        missing = []
         for movie in movies:
             if movie.monitored and not movie.hasFile:
                 if movie.isAvailable:
@@ -62,107 +72,88 @@ class RadarrAPI(object):
 
         for title, ma, mid, title_slug in missing:
             hash_id = hashit(f'{self.server.id}{title}{mid}')
-            influx_payload.append(
-                {
-                    "measurement": "Radarr",
-                    "tags": {
-                        "Missing": True,
-                        "Missing_Available": ma,
-                        "tmdbId": mid,
-                        "server": self.server.id,
-                        "name": title,
-                        "titleSlug": title_slug
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-                    }
+            influx_payload.add(
+                tags={
+                    "Missing": True,
+                    "Missing_Available": ma,
+                    "tmdbId": mid,
+                    "server": self.server.id,
+                    "name": title,
+                    "titleSlug": title_slug
+                },
+                fields={
+                    "hash": hash_id
                 }
             )
 
-        if influx_payload:
-            self.dbmanager.write_points(influx_payload)
-        else:
-            self.logger.warning("No data to send to influx for radarr-missing instance, discarding.")
+    def add_missing_columns(self, movies, influx_payload):
+        # Same points as add_missing, filtered and encoded a column at a time
+        batch = ColumnBatch.from_records(movies, self.movie_decoder.projection)
+        batch = batch.select(true=('monitored',), false=('hasFile',))
+        names = [f'{title} ({year})' for title, year in zip(batch['title'], batch['year'])]
+        tmdb_ids = batch['tmdbId']
+        influx_payload.add_columns(
+            tags={
+                "Missing": True,
+                "Missing_Available": batch.choose('isAvailable', 0, 1),
+                "tmdbId": tmdb_ids,
+                "server": self.server.id,
+                "name": names,
+                "titleSlug": batch['titleSlug']
+            },
+            fields={
+                "hash": [hashit(f'{self.server.id}{name}{tmdb_id}') for name, tmdb_id in zip(names, tmdb_ids)]
+            },
+            count=len(batch)
+        )
 
     def get_queue(self):
         endpoint = '/api/v3/queue'
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        influx_payload = []
+        influx_payload = LineProtocol('Radarr', now)
         pageSize = 250
         params = {'pageSize': pageSize, 'includeMovie': True, 'includeUnknownMovieItems': False}
-        queueResponse = []
-        queue = []
 
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        queueResponse = fetch_pages(self.session, self.server.url + endpoint, params, self.server.verify_ssl,
+                                    timeout=self.server.timeout)
 
-        if not get:
+        if not queueResponse:
             return
 
-        response = QueuePages(**get)
-        queueResponse.extend(response.records)
-
-        while response.totalRecords > response.page * response.pageSize:
-            page = response.page + 1
-            params = {'pageSize': pageSize, 'page': page, 'includeMovie': True, 'includeUnknownMovieItems': False}
-            req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-            get = connection_handler(self.session, req, self.server.verify_ssl)
-            if not get:
-                return
-
-            response = QueuePages(**get)
-            queueResponse.extend(response.records)
-
-        for item in queueResponse:
-            try:
-                # Filtrer les champs qui ne sont pas dans RadarrQueue
-                queue_data = {k: v for k, v in item.items() if k in RadarrQueue._fields}
-                queue.append(RadarrQueue(**queue_data))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating RadarrQueue structure for queue item. Data '
-                                  'attempted is: %s', e, item)
-                # Log les champs problématiques pour debug
-                problematic_fields = [k for k in item.keys() if k not in RadarrQueue._fields]
-                if problematic_fields:
-                    self.logger.debug('Champs non reconnus dans RadarrQueue: %s', problematic_fields)
+        queue = self.queue_decoder.decode_all(queueResponse)
 
         for item in queue:
             if item.movie:
-                movie = item.movie
+                movie = self.movie_decoder(item.movie)
                 hash_id = hashit(f'{self.server.id}{movie.title}{movie.tmdbId}')
-                influx_payload.append(
-                    {
-                        "measurement": "Radarr",
-                        "tags": {
-                            "type": "queue",
-                            "tmdbId": movie.tmdbId,
-                            "server": self.server.id,
-                            "name": movie.title,
-                            "quality": item.quality["quality"]["name"],
-                            "size": item.size,
-                            "title": item.title,
-                            "timeleft": item.timeleft,
-                            "estimatedCompletionTime": item.estimatedCompletionTime,
-                            "status": item.status,
-                            "trackedDownloadState": item.trackedDownloadState,
-                            "trackedDownloadStatus": item.trackedDownloadStatus,
-                            "downloadClient": item.downloadClient,
-                            "protocol": item.protocol,
-                            "indexer": item.indexer,
-                            "outputPath": item.outputPath,
-                            "id": item.id
-                        },
-                        "time": now,
-                        "fields": {
-                            "hash": hash_id,
-                            "sizeleft": item.sizeleft,
-                            "customFormatScore": item.customFormatScore
-                        }
+                influx_payload.add(
+                    tags={
+                        "type": "queue",
+                        "tmdbId": movie.tmdbId,
+                        "server": self.server.id,
+                        "name": movie.title,
+                        "quality": item.quality["quality"]["name"],
+                        "size": item.size,
+                        "title": item.title,
+                        "timeleft": item.timeleft,
+                        "estimatedCompletionTime": item.estimatedCompletionTime,
+                        "status": item.status,
+                        "trackedDownloadState": item.trackedDownloadState,
+                        "trackedDownloadStatus": item.trackedDownloadStatus,
+                        "downloadClient": item.downloadClient,
+                        "protocol": item.protocol,
+                        "indexer": item.indexer,
+                        "outputPath": item.outputPath,
+                        "id": item.id
+                    },
+                    fields={
+                        "hash": hash_id,
+                        "sizeleft": item.sizeleft,
+                        "customFormatScore": item.customFormatScore
                     }
                 )
 
         if influx_payload:
-            self.dbmanager.write_points(influx_payload)
+            self.dbmanager.write_points(influx_payload.lines)
         else:
             self.logger.warning("No data to send to influx for radarr-queue instance, discarding.")
@@ -0,0 +1,61 @@
+from time import monotonic
+from logging import getLogger
+from collections import Counter
+from threading import Thread, Lock
+from queue import Queue, Full
+
+
+def job_name(job, kwargs):
+    owner = getattr(job, '__self__', None)
+    name = f'{owner!r}.{job.__name__}' if owner is not None else job.__name__
+    if kwargs:
+        name += '({})'.format(', '.join(f'{k}={v}' for k, v in sorted(kwargs.items())))
+    return name
+
+
+class WorkerPool(object):
+    """
+    Runs scheduled jobs on a fixed number of worker threads. A job that is still queued or running when it
+    is scheduled again is skipped and counted as an overrun instead of piling up another run.
+    """
+    def __init__(self, workers=10, max_queue=100):
+        self.logger = getLogger()
+        self.queue = Queue(maxsize=max_queue)
+        self.lock = Lock()
+        self.active = set()
+        self.overruns = Counter()
+        self.dropped = 0
+
+        for number in range(workers):
+            Thread(target=self.worker, name=f'varken-worker-{number}', daemon=True).start()
+
+    def submit(self, job, **kwargs):
+        key = (job, tuple(sorted(kwargs.items())))
+
+        with self.lock:
+            if key in self.active:
+                self.overruns[key] += 1
+                self.logger.warning('%s is still running. Skipping this run. (%s overruns)',
+                                    job_name(job, kwargs), self.overruns[key])
+                return
+            try:
+                self.queue.put_nowait((key, job, kwargs))
+            except Full:
+                self.dropped += 1
+                self.logger.warning('Job queue is full (%s jobs waiting). Dropping this run of %s. (%s dropped)',
+                                    self.queue.maxsize, job_name(job, kwargs), self.dropped)
+                return
+            self.active.add(key)
+
+    def worker(self):
+        while True:
+            key, job, kwargs = self.queue.get()
+            started = monotonic()
+            try:
+                job(**kwargs)
+            except Exception as e:
+                self.logger.exception('Unhandled error while running %s: %s', job_name(job, kwargs), e)
+            finally:
+                with self.lock:
+                    self.active.discard(key)
+                self.logger.debug('%s finished in %.2fs', job_name(job, kwargs), monotonic() - started)
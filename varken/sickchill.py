@@ -4,10 +4,15 @@ from datetime import datetime, timezone
 
 from varken.structures import SickChillTVShow
 from varken.helpers import hashit, connection_handler
+from varken.lineprotocol import LineProtocol
+from varken.changes import ChangeDetector
+from varken.decoder import StructDecoder
 
 
 class SickChillAPI(object):
-    def __init__(self, server, dbmanager):
+    show_decoder = StructDecoder(SickChillTVShow)
+
+    def __init__(self, server, dbmanager, statestore=None):
         self.dbmanager = dbmanager
         self.server = server
         # Create session to reduce server web thread load, and globally define pageSize for all requests
@@ -15,27 +20,26 @@ class SickChillAPI(object):
         self.session.params = {'limit': 1000}
         self.endpoint = f"/api/{self.server.api_key}"
         self.logger = getLogger()
+        self.change_detector = None
+        if self.server.change_detection:
+            self.change_detector = ChangeDetector(self.server.full_refresh_seconds, statestore)
 
     def __repr__(self):
         return f"<sickchill-{self.server.id}>"
 
     def get_missing(self):
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        influx_payload = []
+        influx_payload = LineProtocol('SickChill', now)
         params = {'cmd': 'future', 'paused': 1, 'type': 'missed|today|soon|later|snatched'}
 
         req = self.session.prepare_request(Request('GET', self.server.url + self.endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get:
             return
 
-        try:
-            for key, section in get['data'].items():
-                get['data'][key] = [SickChillTVShow(**show) for show in section]
-        except TypeError as e:
-            self.logger.error('TypeError has occurred : %s while creating SickChillTVShow structure', e)
-            return
+        for key, section in get['data'].items():
+            get['data'][key] = self.show_decoder.decode_all(section)
 
         for key, section in get['data'].items():
             for show in section:
@@ -43,26 +47,25 @@ class SickChillAPI(object):
                 hash_id = hashit(f'{self.server.id}{show.show_name}{sxe}')
                 missing_types = [(0, 'future'), (1, 'later'), (2, 'soon'), (3, 'today'), (4, 'missed')]
                 try:
-                    influx_payload.append(
-                        {
-                            "measurement": "SickChill",
-                            "tags": {
-                                "type": [item[0] for item in missing_types if key in item][0],
-                                "indexerid": show.indexerid,
-                                "server": self.server.id,
-                                "name": show.show_name,
-                                "epname": show.ep_name,
-                                "sxe": sxe,
-                                "airdate": show.airdate,
-                            },
-                            "time": now,
-                            "fields": {
-                                "hash": hash_id
-                            }
+                    influx_payload.add(
+                        tags={
+                            "type": [item[0] for item in missing_types if key in item][0],
+                            "indexerid": show.indexerid,
+                            "server": self.server.id,
+                            "name": show.show_name,
+                            "epname": show.ep_name,
+                            "sxe": sxe,
+                            "airdate": show.airdate,
+                        },
+                        fields={
+                            "hash": hash_id
                         }
                     )
                 except IndexError as e:
                     self.logger.error('Error building payload for sickchill. Discarding. Error: %s', e)
 
-        if influx_payload:
-            self.dbmanager.write_points(influx_payload)
+        lines = influx_payload.lines
+        if self.change_detector:
+            lines = self.change_detector.changes(f'sickchill-{self.server.id}-missing', influx_payload)
+        if lines:
+            self.dbmanager.write_points(lines)
@@ -2,12 +2,24 @@ from logging import getLogger
 from requests import Session, Request
 from datetime import datetime, timezone, date, timedelta
 
-from varken.structures import SonarrEpisode, SonarrTVShow, SonarrQueue, QueuePages
-from varken.helpers import hashit, connection_handler
+from varken.structures import SonarrEpisode, SonarrTVShow, SonarrQueue
+from varken.helpers import hashit, connection_handler, fetch_pages
+from varken.lineprotocol import LineProtocol
+from varken.changes import ChangeDetector
+from varken.decoder import StructDecoder
+from varken.columnar import ColumnBatch
 
 
 class SonarrAPI(object):
-    def __init__(self, server, dbmanager):
+    episode_decoder = StructDecoder(SonarrEpisode)
+    # The calendar returns every episode in the window, keep just what get_calendar reads
+    calendar_decoder = StructDecoder(SonarrEpisode, fields=('series', 'seasonNumber', 'episodeNumber', 'hasFile',
+                                                            'monitored', 'title', 'airDateUtc', 'seriesId'),
+                                     compact=True)
+    series_decoder = StructDecoder(SonarrTVShow)
+    queue_decoder = StructDecoder(SonarrQueue)
+
+    def __init__(self, server, dbmanager, statestore=None):
         self.dbmanager = dbmanager
         self.server = server
         # Create session to reduce server web thread load, and globally define pageSize for all requests
@@ -15,6 +27,9 @@ class SonarrAPI(object):
         self.session.headers = {'X-Api-Key': self.server.api_key}
         self.session.params = {'pageSize': 1000}
         self.logger = getLogger()
+        self.change_detector = None
+        if self.server.change_detection:
+            self.change_detector = ChangeDetector(self.server.full_refresh_seconds, statestore)
 
     def __repr__(self):
         return f"<sonarr-{self.server.id}>"
@@ -24,12 +39,12 @@ class SonarrAPI(object):
         params = {'episodeIds': id}
 
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get:
             return
 
-        return SonarrEpisode(**get[0])
+        return self.episode_decoder(get[0])
 
     def get_calendar(self, query="Missing"):
         endpoint = '/api/v3/calendar/'
@@ -41,24 +56,31 @@ class SonarrAPI(object):
             params = {'start': last_days, 'end': today, 'includeSeries': True}
         else:
             params = {'start': today, 'end': future, 'includeSeries': True}
-        influx_payload = []
-        air_days = []
-        missing = []
+        influx_payload = LineProtocol('Sonarr', now)
 
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get:
             return
 
-        tv_shows = []
-        for show in get:
-            try:
-                tv_shows.append(SonarrEpisode(**show))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating SonarrEpisode structure for show. Data '
-                                  'attempted is: %s', e, show)
+        tv_shows = self.calendar_decoder.decode_all(get)
+        if self.server.columnar:
+            self.add_calendar_columns(tv_shows, query, influx_payload)
+        else:
+            self.add_calendar(tv_shows, query, influx_payload)
+
+        lines = influx_payload.lines
+        if self.change_detector:
+            lines = self.change_detector.changes(f'sonarr-{self.server.id}-calendar-{query}', influx_payload)
+        if lines:
+            self.dbmanager.write_points(lines)
+        elif not influx_payload:
+            self.logger.warning("No data to send to influx for sonarr-calendar instance, discarding.")
 
+    def add_calendar(self, tv_shows, query, influx_payload):
+        air_days = []
+        missing = []
         for episode in tv_shows:
             tvShow = episode.series
             sxe = f'S{episode.seasonNumber:0>2}E{episode.episodeNumber:0>2}'
@@ -75,80 +97,72 @@ class SonarrAPI(object):
 
         for series_title, dl_status, sxe, episode_title, air_date_utc, sonarr_id in (air_days or missing):
             hash_id = hashit(f'{self.server.id}{series_title}{sxe}')
-            influx_payload.append(
-                {
-                    "measurement": "Sonarr",
-                    "tags": {
-                        "type": query,
-                        "sonarrId": sonarr_id,
-                        "server": self.server.id,
-                        "name": series_title,
-                        "epname": episode_title,
-                        "sxe": sxe,
-                        "airsUTC": air_date_utc,
-                        "downloaded": dl_status
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-                    }
+            influx_payload.add(
+                tags={
+                    "type": query,
+                    "sonarrId": sonarr_id,
+                    "server": self.server.id,
+                    "name": series_title,
+                    "epname": episode_title,
+                    "sxe": sxe,
+                    "airsUTC": air_date_utc,
+                    "downloaded": dl_status
+                },
+                fields={
+                    "hash": hash_id
                 }
             )
 
-        if influx_payload:
-            self.dbmanager.write_points(influx_payload)
-        else:
-            self.logger.warning("No data to send to influx for sonarr-calendar instance, discarding.")
+    def add_calendar_columns(self, episodes, query, influx_payload):
+        # Same points as add_calendar, filtered and encoded a column at a time
+        batch = ColumnBatch.from_records(episodes, self.calendar_decoder.projection)
+        if query == "Missing":
+            batch = batch.select(true=('monitored',), false=('hasFile',))
+        names = [series['title'] for series in batch['series']]
+        sxes = [f'S{season:0>2}E{episode:0>2}'
+                for season, episode in zip(batch['seasonNumber'], batch['episodeNumber'])]
+        influx_payload.add_columns(
+            tags={
+                "type": query,
+                "sonarrId": batch['seriesId'],
+                "server": self.server.id,
+                "name": names,
+                "epname": batch['title'],
+                "sxe": sxes,
+                "airsUTC": batch['airDateUtc'],
+                "downloaded": batch.choose('hasFile', 1, 0)
+            },
+            fields={
+                "hash": [hashit(f'{self.server.id}{name}{sxe}') for name, sxe in zip(names, sxes)]
+            },
+            count=len(batch)
+        )
 
     def get_queue(self):
-        influx_payload = []
         endpoint = '/api/v3/queue'
         now = datetime.now(timezone.utc).astimezone().isoformat()
+        influx_payload = LineProtocol('Sonarr', now)
         pageSize = 250
         params = {'pageSize': pageSize, 'includeSeries': True, 'includeEpisode': True,
                   'includeUnknownSeriesItems': False}
-        queueResponse = []
         queue = []
 
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
-        if not get:
+        queueResponse = fetch_pages(self.session, self.server.url + endpoint, params, self.server.verify_ssl,
+                                    timeout=self.server.timeout)
+        if not queueResponse:
             return
 
-        response = QueuePages(**get)
-        queueResponse.extend(response.records)
-
-        while response.totalRecords > response.page * response.pageSize:
-            page = response.page + 1
-            params = {'pageSize': pageSize, 'page': page, 'includeSeries': True, 'includeEpisode': True,
-                      'includeUnknownSeriesItems': False}
-            req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-            get = connection_handler(self.session, req, self.server.verify_ssl)
-            if not get:
-                return
-
-            response = QueuePages(**get)
-            queueResponse.extend(response.records)
-
-        download_queue = []
-        for queueItem in queueResponse:
-            try:
-                download_queue.append(SonarrQueue(**queueItem))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating Queue structure. Data attempted is: '
-                                  '%s', e, queueItem)
+        download_queue = self.queue_decoder.decode_all(queueResponse)
         if not download_queue:
             return
 
         for queueItem in download_queue:
-            tvShow = SonarrTVShow(**queueItem.series)
-            try:
-                episode = SonarrEpisode(**queueItem.episode)
-                sxe = f"S{episode.seasonNumber:0>2}E{episode.episodeNumber:0>2}"
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while processing the sonarr queue. \
-                                  Remove invalid queue entry. Data attempted is: %s', e, queueItem)
+            tvShow = self.series_decoder(queueItem.series)
+            episode = self.episode_decoder(queueItem.episode)
+            if tvShow is None or episode is None:
+                self.logger.error('Invalid entry in the sonarr queue. Remove it. Data attempted is: %s', queueItem)
                 continue
+            sxe = f"S{episode.seasonNumber:0>2}E{episode.episodeNumber:0>2}"
 
             if queueItem.protocol.upper() == 'USENET':
                 protocol_id = 1
@@ -160,28 +174,24 @@ class SonarrAPI(object):
 
         for series_title, episode_title, protocol, protocol_id, sxe, sonarr_id, quality in queue:
             hash_id = hashit(f'{self.server.id}{series_title}{sxe}')
-            influx_payload.append(
-                {
-                    "measurement": "Sonarr",
-                    "tags": {
-                        "type": "Queue",
-                        "sonarrId": sonarr_id,
-                        "server": self.server.id,
-                        "name": series_title,
-                        "epname": episode_title,
-                        "sxe": sxe,
-                        "protocol": protocol,
-                        "protocol_id": protocol_id,
-                        "quality": quality
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-                    }
+            influx_payload.add(
+                tags={
+                    "type": "Queue",
+                    "sonarrId": sonarr_id,
+                    "server": self.server.id,
+                    "name": series_title,
+                    "epname": episode_title,
+                    "sxe": sxe,
+                    "protocol": protocol,
+                    "protocol_id": protocol_id,
+                    "quality": quality
+                },
+                fields={
+                    "hash": hash_id
                 }
             )
 
         if influx_payload:
-            self.dbmanager.write_points(influx_payload)
+            self.dbmanager.write_points(influx_payload.lines)
         else:
             self.logger.warning("No data to send to influx for sonarr-queue instance, discarding.")
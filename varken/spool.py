@@ -0,0 +1,98 @@
+from glob import glob
+from time import time_ns
+from threading import Lock
+from logging import getLogger
+from os import remove, stat
+from os.path import join, basename
+
+from varken.helpers import mkdir_p
+
+
+class WriteSpool(object):
+    """
+    Segmented, append-only on-disk spool of line protocol for writes InfluxDB could not accept
+    """
+    extension = '.lp'
+    segment_size = 5000000  # 5 MB
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.logger = getLogger()
+        self.lock = Lock()
+        self.active = None
+        self.evicted_lines = 0
+
+        mkdir_p(self.folder)
+
+        self.segments = sorted(glob(join(self.folder, f'*{self.extension}')))
+        self.sizes = {segment: stat(segment).st_size for segment in self.segments}
+        if self.segments:
+            self.logger.info('Found %s spooled InfluxDB segment(s) (%s bytes) waiting for replay',
+                             len(self.segments), self.size)
+
+    def __len__(self):
+        return len(self.segments)
+
+    @property
+    def size(self):
+        return sum(self.sizes.values())
+
+    def append(self, lines):
+        data = b''.join(line + b'\n' for line in lines)
+        if not data:
+            return
+
+        with self.lock:
+            if self.active is None or self.sizes[self.active] >= self.segment_size:
+                self.active = join(self.folder, f'{time_ns():020d}{self.extension}')
+                self.segments.append(self.active)
+                self.sizes[self.active] = 0
+
+            with open(self.active, 'ab') as segment:
+                segment.write(data)
+            self.sizes[self.active] += len(data)
+
+            self.evict()
+
+    def evict(self):
+        # Drop the oldest segments first so the most recent data survives a long outage
+        while self.size > self.max_size and len(self.segments) > 1:
+            segment = self.segments.pop(0)
+            try:
+                with open(segment, 'rb') as f:
+                    self.evicted_lines += sum(1 for _ in f)
+                remove(segment)
+            except FileNotFoundError:
+                pass
+            del self.sizes[segment]
+            self.logger.warning('InfluxDB spool is over %s bytes. Evicted oldest segment %s. '
+                                '%s spooled lines evicted so far', self.max_size, basename(segment),
+                                self.evicted_lines)
+
+    def claim(self):
+        """Return the oldest segment, sealing it so that new writes go to a fresh segment"""
+        with self.lock:
+            if not self.segments:
+                return None
+            segment = self.segments[0]
+            if segment == self.active:
+                self.active = None
+            return segment
+
+    def read(self, segment):
+        try:
+            with open(segment, 'rb') as f:
+                return [line.rstrip(b'\n') for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def release(self, segment):
+        with self.lock:
+            if segment in self.sizes:
+                self.segments.remove(segment)
+                del self.sizes[segment]
+            try:
+                remove(segment)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,89 @@
+from json import dumps, loads
+from threading import Lock
+from logging import getLogger
+from os.path import join
+from sqlite3 import connect
+
+
+class StateStore(object):
+    """
+    Small SQLite database in the data folder that keeps collector state across restarts. Values are JSON documents
+    stored under a namespace and key (cursors, last-modified markers, checkpoints), and sets are stored as members
+    of a namespace (hashes already seen, points already written).
+    """
+    filename = 'varken.db'
+    schema_version = 1
+
+    def __init__(self, data_folder):
+        self.file_path = join(data_folder, self.filename)
+        self.logger = getLogger()
+        self.lock = Lock()
+
+        # Autocommit, transactions are opened explicitly where several statements belong together
+        self.connection = connect(self.file_path, check_same_thread=False, isolation_level=None)
+        # WAL lets readers carry on while a collector writes, NORMAL sync is safe with WAL and avoids an fsync per write
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.migrate()
+
+    def migrate(self):
+        with self.lock:
+            version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                self.logger.debug('Creating state store schema in %s', self.file_path)
+                self.connection.executescript('''
+                    BEGIN;
+                    CREATE TABLE IF NOT EXISTS state (
+                        namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+                        PRIMARY KEY (namespace, key)) WITHOUT ROWID;
+                    CREATE TABLE IF NOT EXISTS members (
+                        namespace TEXT NOT NULL, member BLOB NOT NULL,
+                        PRIMARY KEY (namespace, member)) WITHOUT ROWID;
+                    COMMIT;
+                ''')
+            self.connection.execute(f'PRAGMA user_version = {self.schema_version}')
+
+    def get(self, namespace, key, default=None):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM state WHERE namespace = ? AND key = ?',
+                                          (namespace, str(key))).fetchone()
+        return loads(row[0]) if row else default
+
+    def set(self, namespace, key, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)',
+                                    (namespace, str(key), dumps(value)))
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self.connection.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, str(key)))
+
+    def members(self, namespace):
+        """Return the set stored under namespace, or None if nothing was ever stored there"""
+        with self.lock:
+            rows = self.connection.execute('SELECT member FROM members WHERE namespace = ?', (namespace,)).fetchall()
+            if not rows and not self.connection.execute("SELECT 1 FROM state WHERE namespace = ? AND key = ''",
+                                                        (namespace,)).fetchone():
+                return None
+        return {bytes(row[0]) for row in rows}
+
+    def update_members(self, namespace, added=(), removed=()):
+        """Add and remove members of the set stored under namespace in a single transaction"""
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.executemany('DELETE FROM members WHERE namespace = ? AND member = ?',
+                                            ((namespace, member) for member in removed))
+                self.connection.executemany('INSERT OR IGNORE INTO members (namespace, member) VALUES (?, ?)',
+                                            ((namespace, member) for member in added))
+                # Marks the set as stored even when it is empty
+                self.connection.execute("INSERT OR IGNORE INTO state (namespace, key, value) VALUES (?, '', 'true')",
+                                        (namespace,))
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
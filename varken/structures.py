@@ -19,6 +19,21 @@ class InfluxServer(NamedTuple):
     username: str = 'root'
     verify_ssl: bool = False
     org: str = '-'
+    buffered_writes: bool = False
+    batch_size: int = 5000
+    flush_interval: float = 1.0
+    spool: bool = True
+    spool_max_mb: int = 100
+    spool_replay_rate: int = 5000
+    payload_log_sample: float = 0.0
+    payload_log_max_chars: int = 2000
+
+
+class WebhookServer(NamedTuple):
+    enabled: bool = False
+    bind: str = '0.0.0.0'
+    port: int = 8089
+    apikey: str = None
 
 
 class SonarrServer(NamedTuple):
@@ -32,6 +47,10 @@ class SonarrServer(NamedTuple):
     queue_run_seconds: int = 30
     url: str = None
     verify_ssl: bool = False
+    timeout: tuple = (5, 30)
+    change_detection: bool = False
+    full_refresh_seconds: int = 3600
+    columnar: bool = False
 
 
 class RadarrServer(NamedTuple):
@@ -43,6 +62,10 @@ class RadarrServer(NamedTuple):
     queue_run_seconds: int = 30
     url: str = None
     verify_ssl: bool = False
+    timeout: tuple = (5, 30)
+    change_detection: bool = False
+    full_refresh_seconds: int = 3600
+    columnar: bool = False
 
 
 class OmbiServer(NamedTuple):
@@ -56,6 +79,7 @@ class OmbiServer(NamedTuple):
     request_type_run_seconds: int = 30
     url: str = None
     verify_ssl: bool = False
+    timeout: tuple = (5, 30)
 
 
 class TautulliServer(NamedTuple):
@@ -69,6 +93,7 @@ class TautulliServer(NamedTuple):
     url: str = None
     verify_ssl: bool = None
     maxmind_license_key: str = None
+    timeout: tuple = (5, 30)
 
 
 class SickChillServer(NamedTuple):
@@ -78,6 +103,9 @@ class SickChillServer(NamedTuple):
     id: int = None
     url: str = None
     verify_ssl: bool = False
+    timeout: tuple = (5, 30)
+    change_detection: bool = False
+    full_refresh_seconds: int = 3600
 
 
 class UniFiServer(NamedTuple):
@@ -89,6 +117,7 @@ class UniFiServer(NamedTuple):
     username: str = 'ubnt'
     usg_name: str = None
     verify_ssl: bool = False
+    timeout: tuple = (5, 30)
 
 
 class OverseerrServer(NamedTuple):
@@ -101,6 +130,7 @@ class OverseerrServer(NamedTuple):
     num_latest_requests_to_fetch: int = 10
     num_latest_requests_seconds: int = 30
     num_total_issue_counts: int = 300
+    timeout: tuple = (5, 30)
 
 
 # Shared
@@ -5,10 +5,27 @@ from datetime import datetime, timezone, date, timedelta
 from influxdb.exceptions import InfluxDBClientError
 
 from varken.structures import TautulliStream
-from varken.helpers import hashit, connection_handler, itemgetter_with_default
+from varken.helpers import hashit, connection_handler, bounded_map, RateLimiter
+from varken.lineprotocol import LineProtocol
+from varken.decoder import StructDecoder
 
 
 class TautulliAPI(object):
+    # Only the few dozen of TautulliStream's 200 odd fields used below are kept
+    stream_decoder = StructDecoder(TautulliStream, compact=True, fields=(
+        'audio_codec', 'audio_profile', 'container', 'friendly_name', 'full_title', 'id', 'ip_address',
+        'ip_address_public', 'media_type', 'platform', 'product', 'product_version', 'progress_percent',
+        'quality_profile', 'relayed', 'secure', 'session_id', 'session_key', 'started', 'state', 'stopped',
+        'stream_audio_codec', 'stream_video_decision', 'stream_video_full_resolution', 'stream_video_resolution',
+        'transcode_decision', 'transcode_hw_decoding', 'transcode_hw_encoding', 'user', 'username'))
+    # Number of historical sessions written to InfluxDB at a time
+    historical_chunk_size = 1000
+    # Rows requested per get_history page
+    history_page_size = 1000
+    # Concurrent get_stream_data requests and the most started per second during a historical import
+    stream_data_workers = 4
+    stream_data_rate = 20
+
     def __init__(self, server, dbmanager, geoiphandler):
         self.dbmanager = dbmanager
         self.server = server
@@ -18,29 +35,24 @@ class TautulliAPI(object):
         self.endpoint = '/api/v2'
         self.logger = getLogger()
         self.my_ip = None
+        self.rate_limiter = RateLimiter(self.stream_data_rate)
 
     def __repr__(self):
         return f"<tautulli-{self.server.id}>"
 
     def get_activity(self):
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        influx_payload = []
+        influx_payload = LineProtocol('Tautulli', now)
         params = {'cmd': 'get_activity'}
 
         req = self.session.prepare_request(Request('GET', self.server.url + self.endpoint, params=params))
-        g = connection_handler(self.session, req, self.server.verify_ssl)
+        g = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not g:
             return
 
         get = g['response']['data']
-        fields = itemgetter_with_default(**TautulliStream._field_defaults)
-
-        try:
-            sessions = [TautulliStream(*fields(session)) for session in get['sessions']]
-        except TypeError as e:
-            self.logger.error('TypeError has occurred : %s while creating TautulliStream structure', e)
-            return
+        sessions = self.stream_decoder.decode_all(get['sessions'])
 
         for session in sessions:
             # Check to see if ip_address_public attribute exists as it was introduced in v2
@@ -123,76 +135,68 @@ class TautulliAPI(object):
                 platform_name = 'Windows'
 
             hash_id = hashit(f'{session.session_id}{session.session_key}{session.username}{session.full_title}')
-            influx_payload.append(
-                {
-                    "measurement": "Tautulli",
-                    "tags": {
-                        "type": "Session",
-                        "session_id": session.session_id,
-                        "friendly_name": session.friendly_name,
-                        "username": session.username,
-                        "title": session.full_title,
-                        "product": session.product,
-                        "platform": platform_name,
-                        "product_version": product_version,
-                        "quality": quality,
-                        "video_decision": video_decision.title(),
-                        "transcode_decision": decision.title(),
-                        "transcode_hw_decoding": session.transcode_hw_decoding,
-                        "transcode_hw_encoding": session.transcode_hw_encoding,
-                        "media_type": session.media_type.title(),
-                        "audio_codec": session.audio_codec.upper(),
-                        "audio_profile": session.audio_profile.upper(),
-                        "stream_audio_codec": session.stream_audio_codec.upper(),
-                        "quality_profile": session.quality_profile,
-                        "progress_percent": session.progress_percent,
-                        "region_code": geodata.subdivisions.most_specific.iso_code,
-                        "location": location,
-                        "full_location": f'{geodata.subdivisions.most_specific.name} - {geodata.city.name}',
-                        "latitude": latitude,
-                        "longitude": longitude,
-                        "player_state": player_state,
-                        "device_type": platform_name,
-                        "relayed": session.relayed,
-                        "secure": session.secure,
-                        "server": self.server.id
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-                    }
-                }
-            )
-
-        influx_payload.append(
-            {
-                "measurement": "Tautulli",
-                "tags": {
-                    "type": "current_stream_stats",
+            influx_payload.add(
+                tags={
+                    "type": "Session",
+                    "session_id": session.session_id,
+                    "friendly_name": session.friendly_name,
+                    "username": session.username,
+                    "title": session.full_title,
+                    "product": session.product,
+                    "platform": platform_name,
+                    "product_version": product_version,
+                    "quality": quality,
+                    "video_decision": video_decision.title(),
+                    "transcode_decision": decision.title(),
+                    "transcode_hw_decoding": session.transcode_hw_decoding,
+                    "transcode_hw_encoding": session.transcode_hw_encoding,
+                    "media_type": session.media_type.title(),
+                    "audio_codec": session.audio_codec.upper(),
+                    "audio_profile": session.audio_profile.upper(),
+                    "stream_audio_codec": session.stream_audio_codec.upper(),
+                    "quality_profile": session.quality_profile,
+                    "progress_percent": session.progress_percent,
+                    "region_code": geodata.subdivisions.most_specific.iso_code,
+                    "location": location,
+                    "full_location": f'{geodata.subdivisions.most_specific.name} - {geodata.city.name}',
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "player_state": player_state,
+                    "device_type": platform_name,
+                    "relayed": session.relayed,
+                    "secure": session.secure,
                     "server": self.server.id
                 },
-                "time": now,
-                "fields": {
-                    "stream_count": int(get['stream_count']),
-                    "total_bandwidth": int(get['total_bandwidth']),
-                    "wan_bandwidth": int(get['wan_bandwidth']),
-                    "lan_bandwidth": int(get['lan_bandwidth']),
-                    "transcode_streams": int(get['stream_count_transcode']),
-                    "direct_play_streams": int(get['stream_count_direct_play']),
-                    "direct_streams": int(get['stream_count_direct_stream'])
+                fields={
+                    "hash": hash_id
                 }
+            )
+
+        influx_payload.add(
+            tags={
+                "type": "current_stream_stats",
+                "server": self.server.id
+            },
+            fields={
+                "stream_count": int(get['stream_count']),
+                "total_bandwidth": int(get['total_bandwidth']),
+                "wan_bandwidth": int(get['wan_bandwidth']),
+                "lan_bandwidth": int(get['lan_bandwidth']),
+                "transcode_streams": int(get['stream_count_transcode']),
+                "direct_play_streams": int(get['stream_count_direct_play']),
+                "direct_streams": int(get['stream_count_direct_stream'])
             }
         )
 
-        self.dbmanager.write_points(influx_payload)
+        self.dbmanager.write_points(influx_payload.lines)
 
     def get_stats(self):
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        influx_payload = []
+        influx_payload = LineProtocol('Tautulli', now)
         params = {'cmd': 'get_libraries'}
 
         req = self.session.prepare_request(Request('GET', self.server.url + self.endpoint, params=params))
-        g = connection_handler(self.session, req, self.server.verify_ssl)
+        g = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not g:
             return
@@ -200,65 +204,54 @@ class TautulliAPI(object):
         get = g['response']['data']
 
         for library in get:
-            data = {
-                "measurement": "Tautulli",
-                    "tags": {
-                        "type": "library_stats",
-                        "server": self.server.id,
-                        "section_name": library['section_name'],
-                        "section_type": library['section_type']
-                    },
-                    "time": now,
-                    "fields": {
-                        "total": int(library['count'])
-                    }
+            tags = {
+                "type": "library_stats",
+                "server": self.server.id,
+                "section_name": library['section_name'],
+                "section_type": library['section_type']
+            }
+            fields = {
+                "total": int(library['count'])
             }
             if library['section_type'] == 'show':
-                data['fields']['seasons'] = int(library['parent_count'])
-                data['fields']['episodes'] = int(library['child_count'])
+                fields['seasons'] = int(library['parent_count'])
+                fields['episodes'] = int(library['child_count'])
 
             elif library['section_type'] == 'artist':
-                data['fields']['artists'] = int(library['count'])
-                data['fields']['albums'] = int(library['parent_count'])
-                data['fields']['tracks'] = int(library['child_count'])
-            influx_payload.append(data)
+                fields['artists'] = int(library['count'])
+                fields['albums'] = int(library['parent_count'])
+                fields['tracks'] = int(library['child_count'])
+            influx_payload.add(tags=tags, fields=fields)
 
-        self.dbmanager.write_points(influx_payload)
+        self.dbmanager.write_points(influx_payload.lines)
 
-    def get_historical(self, days=30):
-        influx_payload = []
+    def get_historical(self, days=30, checkpoint=None, resume=False):
+        influx_payload = LineProtocol('Tautulli')
         start_date = date.today() - timedelta(days=days)
-        params = {'cmd': 'get_history', 'grouping': 1, 'length': 1000000}
-        req = self.session.prepare_request(Request('GET', self.server.url + self.endpoint, params=params))
-        g = connection_handler(self.session, req, self.server.verify_ssl)
-
-        if not g:
+        last_row, last_started = 0, None
+        if checkpoint and resume:
+            last_row, last_started = checkpoint.get(self.server.id)
+            if last_started:
+                # Go back a day to catch sessions that started before the last imported one but stopped after it
+                start_date = max(start_date, date.fromtimestamp(last_started) - timedelta(days=1))
+                self.logger.info('Resuming import from tautulli-%s after row %s, fetching history since %s',
+                                 self.server.id, last_row, start_date)
+
+        page = self.get_history_page(start_date, 0)
+        if not page:
             return
 
-        get = g['response']['data']['data']
+        total = page['recordsFiltered']
+        imported = 0
+        failed = 0
+        self.logger.info('Importing %s historical sessions from tautulli-%s', total, self.server.id)
 
-        params = {'cmd': 'get_stream_data', 'row_id': 0}
-        sessions = []
-        for history_item in get:
-            if not history_item['id']:
-                self.logger.debug('Skipping entry with no ID. (%s)', history_item['full_title'])
-                continue
-            if date.fromtimestamp(history_item['started']) < start_date:
+        for session in self.get_historical_sessions(self.get_history(start_date, page, last_row)):
+            if session is None:
+                # Keep the checkpoint before the first row that failed so a resumed import fetches it again.
+                # Rows imported after it are written again then, which overwrites the same points
+                failed += 1
                 continue
-            params['row_id'] = history_item['id']
-            req = self.session.prepare_request(Request('GET', self.server.url + self.endpoint, params=params))
-            g = connection_handler(self.session, req, self.server.verify_ssl)
-            if not g:
-                self.logger.debug('Could not get historical stream data for %s. Skipping.', history_item['full_title'])
-            try:
-                self.logger.debug('Adding %s to history', history_item['full_title'])
-                history_item.update(g['response']['data'])
-                sessions.append(TautulliStream(**history_item))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating TautulliStream structure', e)
-                continue
-
-        for session in sessions:
             try:
                 geodata = self.geoiphandler.lookup(session.ip_address)
             except (ValueError, AddressNotFoundError):
@@ -321,48 +314,127 @@ class TautulliAPI(object):
             player_state = 100
 
             hash_id = hashit(f'{session.id}{session.session_key}{session.user}{session.full_title}')
-            influx_payload.append(
-                {
-                    "measurement": "Tautulli",
-                    "tags": {
-                        "type": "Session",
-                        "session_id": session.session_id,
-                        "friendly_name": session.friendly_name,
-                        "username": session.user,
-                        "title": session.full_title,
-                        "product": session.product,
-                        "platform": platform_name,
-                        "quality": quality,
-                        "video_decision": video_decision.title(),
-                        "transcode_decision": decision.title(),
-                        "transcode_hw_decoding": session.transcode_hw_decoding,
-                        "transcode_hw_encoding": session.transcode_hw_encoding,
-                        "media_type": session.media_type.title(),
-                        "audio_codec": session.audio_codec.upper(),
-                        "stream_audio_codec": session.stream_audio_codec.upper(),
-                        "quality_profile": session.quality_profile,
-                        "progress_percent": session.progress_percent,
-                        "region_code": geodata.subdivisions.most_specific.iso_code,
-                        "location": location,
-                        "full_location": f'{geodata.subdivisions.most_specific.name} - {geodata.city.name}',
-                        "latitude": latitude,
-                        "longitude": longitude,
-                        "player_state": player_state,
-                        "device_type": platform_name,
-                        "relayed": session.relayed,
-                        "secure": session.secure,
-                        "server": self.server.id
-                    },
-                    "time": datetime.fromtimestamp(session.stopped).astimezone().isoformat(),
-                    "fields": {
-                        "hash": hash_id
-                    }
-                }
+            influx_payload.add(
+                tags={
+                    "type": "Session",
+                    "session_id": session.session_id,
+                    "friendly_name": session.friendly_name,
+                    "username": session.user,
+                    "title": session.full_title,
+                    "product": session.product,
+                    "platform": platform_name,
+                    "quality": quality,
+                    "video_decision": video_decision.title(),
+                    "transcode_decision": decision.title(),
+                    "transcode_hw_decoding": session.transcode_hw_decoding,
+                    "transcode_hw_encoding": session.transcode_hw_encoding,
+                    "media_type": session.media_type.title(),
+                    "audio_codec": session.audio_codec.upper(),
+                    "stream_audio_codec": session.stream_audio_codec.upper(),
+                    "quality_profile": session.quality_profile,
+                    "progress_percent": session.progress_percent,
+                    "region_code": geodata.subdivisions.most_specific.iso_code,
+                    "location": location,
+                    "full_location": f'{geodata.subdivisions.most_specific.name} - {geodata.city.name}',
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "player_state": player_state,
+                    "device_type": platform_name,
+                    "relayed": session.relayed,
+                    "secure": session.secure,
+                    "server": self.server.id
+                },
+                fields={
+                    "hash": hash_id
+                },
+                time=datetime.fromtimestamp(session.stopped).astimezone().isoformat()
             )
-            try:
-                self.dbmanager.write_points(influx_payload)
-            except InfluxDBClientError as e:
-                if "beyond retention policy" in str(e):
-                    self.logger.debug('Only imported 30 days of data per retention policy')
-                else:
-                    self.logger.error('Something went wrong... post this output in discord: %s', e)
+            imported += 1
+            if not failed and int(session.id) > last_row:
+                last_row, last_started = int(session.id), session.started
+
+            if len(influx_payload) >= self.historical_chunk_size:
+                self.write_historical(influx_payload)
+                if checkpoint:
+                    checkpoint.set(self.server.id, last_row, last_started)
+                self.logger.info('Imported %s/%s historical sessions from tautulli-%s', imported, total,
+                                 self.server.id)
+
+        if influx_payload:
+            self.write_historical(influx_payload)
+            if checkpoint:
+                checkpoint.set(self.server.id, last_row, last_started)
+        self.logger.info('Finished importing %s/%s historical sessions from tautulli-%s', imported, total,
+                         self.server.id)
+        if failed:
+            self.logger.warning('Could not get stream data for %s historical sessions from tautulli-%s. '
+                                'Run the import again with --resume to retry them', failed, self.server.id)
+
+    def get_history_page(self, start_date, start):
+        """
+        Get one page of history rows since start_date in the order they were stopped, which is also the order
+        their row ids are given out in. Offsets stay stable while paging and an import can resume from a row id.
+        """
+        params = {'cmd': 'get_history', 'grouping': 1, 'after': start_date.isoformat(), 'order_column': 'stopped',
+                  'order_dir': 'asc', 'start': start, 'length': self.history_page_size}
+        req = self.session.prepare_request(Request('GET', self.server.url + self.endpoint, params=params))
+        g = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
+
+        if not g:
+            return
+
+        return g['response']['data']
+
+    def get_history(self, start_date, page, after_row=0):
+        """Yield the history rows of page and of every page after it, skipping rows up to after_row"""
+        start = 0
+        while page:
+            for history_item in page['data']:
+                if not history_item['id']:
+                    self.logger.debug('Skipping entry with no ID. (%s)', history_item['full_title'])
+                    continue
+                if date.fromtimestamp(history_item['started']) < start_date:
+                    continue
+                if history_item['id'] <= after_row:
+                    continue
+                yield history_item
+
+            start += len(page['data'])
+            if len(page['data']) < self.history_page_size or start >= page['recordsFiltered']:
+                return
+            page = self.get_history_page(start_date, start)
+            if not page:
+                self.logger.error('Could not get history from tautulli-%s past row %s. Stopping import.',
+                                  self.server.id, start)
+
+    def get_stream_data(self, history_item):
+        self.rate_limiter.wait()
+        params = {'cmd': 'get_stream_data', 'row_id': history_item['id']}
+        req = self.session.prepare_request(Request('GET', self.server.url + self.endpoint, params=params))
+        g = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
+        return history_item, g
+
+    def get_historical_sessions(self, history):
+        """
+        Enrich each history row with its stream data, yielding one TautulliStream at a time in history order,
+        or None for a row whose stream data could not be fetched
+        """
+        for history_item, g in bounded_map(self.get_stream_data, history, self.stream_data_workers):
+            if not g:
+                self.logger.warning('Could not get historical stream data for row %s (%s). Skipping.',
+                                    history_item['id'], history_item['full_title'])
+                yield None
+                continue
+            self.logger.debug('Adding %s to history', history_item['full_title'])
+            history_item.update(g['response']['data'])
+            yield self.stream_decoder(history_item)
+
+    def write_historical(self, influx_payload):
+        try:
+            self.dbmanager.write_points(influx_payload.lines)
+        except InfluxDBClientError as e:
+            if "beyond retention policy" in str(e):
+                self.logger.debug('Only imported 30 days of data per retention policy')
+            else:
+                self.logger.error('Something went wrong... post this output in discord: %s', e)
+        influx_payload.clear()
@@ -24,7 +24,8 @@ class UniFiAPI(object):
         endpoint = '/api/login'
         pre_cookies = {'username': self.server.username, 'password': self.server.password, 'remember': True}
         req = self.session.prepare_request(Request('POST', self.server.url + endpoint, json=pre_cookies))
-        post = connection_handler(self.session, req, self.server.verify_ssl, as_is_reply=True)
+        post = connection_handler(self.session, req, self.server.verify_ssl, as_is_reply=True,
+                                  timeout=self.server.timeout)
 
         if not post or not post.cookies.get('unifises'):
             self.logger.error("Could not retrieve session cookie from UniFi Controller")
@@ -36,7 +37,7 @@ class UniFiAPI(object):
     def get_site(self):
         endpoint = '/api/self/sites'
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get:
             self.logger.error("Could not get list of sites from UniFi Controller")
@@ -52,7 +53,7 @@ class UniFiAPI(object):
         now = datetime.now(timezone.utc).astimezone().isoformat()
         endpoint = f'/api/s/{self.site}/stat/device'
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = connection_handler(self.session, req, self.server.verify_ssl, timeout=self.server.timeout)
 
         if not get:
             if self.get_retry:
@@ -1,5 +1,9 @@
-from logging.handlers import RotatingFileHandler
-from logging import Filter, DEBUG, INFO, getLogger, Formatter, StreamHandler
+from copy import copy
+from atexit import register
+from re import compile, escape
+from queue import Queue, Full
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from logging import Filter, DEBUG, INFO, NOTSET, WARNING, getLogger, Formatter, StreamHandler, makeLogRecord
 
 from varken.helpers import mkdir_p
 
@@ -15,25 +19,92 @@ class BlacklistFilter(Filter):
 
     blacklisted_strings = ['apikey', 'username', 'password', 'url']
 
-    def __init__(self, filteredstrings):
+    def __init__(self, filteredstrings, level=NOTSET):
         super().__init__()
         self.filtered_strings = filteredstrings
+        # Records below this level are never emitted, so they are not worth redacting
+        self.level = level
+        # Longest first so a secret that contains another one is redacted whole
+        strings = sorted(filter(None, filteredstrings), key=len, reverse=True)
+        self.pattern = compile('|'.join(escape(item) for item in strings)) if strings else None
+
+    @staticmethod
+    def redact(match):
+        return 8 * '*' + match.group()[-5:]
 
     def filter(self, record):
-        for item in self.filtered_strings:
-            try:
-                if item in record.msg:
-                    record.msg = record.msg.replace(item, 8 * '*' + item[-5:])
-                if any(item in str(arg) for arg in record.args):
-                    record.args = tuple(arg.replace(item, 8 * '*' + item[-5:]) if isinstance(arg, str) else arg
-                                        for arg in record.args)
-            except TypeError:
-                pass
+        if self.pattern is None or record.levelno < self.level or getattr(record, 'redacted', False):
+            return True
+        try:
+            message = record.getMessage()
+        except (TypeError, ValueError):
+            # Let the handler report the broken format string
+            return True
+        redacted = self.pattern.sub(self.redact, message)
+        if redacted != message:
+            record.msg = redacted
+            record.args = ()
+        # Every handler shares this record, only scan it once
+        record.redacted = True
         return True
 
 
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to a QueueListener thread without blocking the caller. When the queue is full, records below
+    WARNING are dropped straight away and more important ones wait up to block_timeout seconds for room.
+    """
+    block_timeout = 1
+
+    def __init__(self, queue, listener_handlers):
+        super().__init__(queue)
+        self.listener = QueueListener(queue, *listener_handlers, respect_handler_level=True)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Render the message now, its args may change before the listener thread gets to it. Formatting and the
+        # redaction filter are left to the listener thread
+        record = copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if record.levelno >= WARNING:
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            return
+
+        if self.dropped:
+            try:
+                self.queue.put_nowait(makeLogRecord({
+                    'name': record.name, 'levelno': WARNING, 'levelname': 'WARNING', 'module': 'varkenlogger',
+                    'msg': 'Logging queue was full. Dropped %s log records', 'args': (self.dropped,)}))
+            except Full:
+                return
+            self.dropped = 0
+
+    @property
+    def handlers(self):
+        return self.listener.handlers
+
+
+def log_handlers(logger):
+    """Return the handlers that actually emit the records of logger, looking through a DroppingQueueHandler"""
+    handlers = []
+    for handler in logger.handlers:
+        handlers.extend(handler.handlers if isinstance(handler, DroppingQueueHandler) else [handler])
+    return handlers
+
+
 class VarkenLogger(object):
-    def __init__(self, debug=None, data_folder=None):
+    queue_size = 10000
+
+    def __init__(self, debug=None, data_folder=None, async_logging=False):
         self.data_folder = data_folder
         self.log_level = debug
 
@@ -70,5 +141,13 @@ class VarkenLogger(object):
         console_logger.setLevel(self.log_level)
 
         # Add the Handler to the Logger
-        self.logger.addHandler(file_logger)
-        self.logger.addHandler(console_logger)
+        if async_logging:
+            # File and console I/O happen on the listener thread instead of in every collector thread
+            queue_handler = DroppingQueueHandler(Queue(self.queue_size), [file_logger, console_logger])
+            queue_handler.setLevel(self.log_level)
+            self.logger.addHandler(queue_handler)
+            queue_handler.listener.start()
+            register(queue_handler.listener.stop)
+        else:
+            self.logger.addHandler(file_logger)
+            self.logger.addHandler(console_logger)
@@ -0,0 +1,127 @@
+from hmac import compare_digest
+from threading import Thread
+from logging import getLogger
+from json import loads, JSONDecodeError
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class WebhookReceiver(object):
+    """
+    Embedded HTTP listener for the webhooks Sonarr, Radarr, Lidarr, Overseerr and Tautulli send on events. Each event
+    runs the pollers whose data it changes right away, so the points written are the same ones the schedule writes.
+    Webhooks are posted to /<service>/<server id>, with the configured apikey as a query parameter or X-Api-Key header.
+    """
+    max_body_size = 1000000
+    # The apikey shipped in varken.example.ini, which is public
+    example_apikey = 'xxxxxxxxxxxxxxxx'
+
+    def __init__(self, server, submit):
+        self.server = server
+        self.submit = submit
+        self.logger = getLogger()
+        self.collectors = {}
+        self.httpd = None
+
+    def add(self, service, server_id, collector):
+        self.collectors[(service, str(server_id))] = collector
+
+    def start(self):
+        apikey = (self.server.apikey or '').strip()
+        if not apikey or apikey == self.example_apikey:
+            # Anyone who can reach the port could otherwise trigger polls of every server
+            self.logger.error('Webhooks are enabled but [webhooks] has no apikey, or still the example one. '
+                              'Not starting the listener')
+            return
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                status = receiver.handle(self)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                receiver.logger.debug('Webhook %s - %s', self.address_string(), format % args)
+
+        self.httpd = ThreadingHTTPServer((self.server.bind, self.server.port), Handler)
+        self.httpd.daemon_threads = True
+        Thread(target=self.httpd.serve_forever, name='webhooks', daemon=True).start()
+        self.logger.info('Listening for webhooks on %s:%s', self.server.bind, self.server.port)
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def handle(self, request):
+        url = urlsplit(request.path)
+        apikey = request.headers.get('X-Api-Key') or parse_qs(url.query).get('apikey', [''])[0]
+        if not compare_digest(apikey.encode(), self.server.apikey.encode()):
+            self.logger.warning('Rejected webhook from %s with a wrong apikey', request.address_string())
+            return 401
+
+        try:
+            service, server_id = url.path.strip('/').split('/')
+        except ValueError:
+            return 404
+        collector = self.collectors.get((service, server_id))
+        if collector is None:
+            self.logger.warning('Received a webhook for %s-%s which is not enabled', service, server_id)
+            return 404
+
+        try:
+            length = int(request.headers.get('Content-Length') or 0)
+        except ValueError:
+            return 400
+        if length < 0 or length > self.max_body_size:
+            return 413
+        try:
+            event = loads(request.rfile.read(length) or b'{}')
+        except (JSONDecodeError, UnicodeDecodeError) as e:
+            self.logger.error('Could not decode webhook for %s-%s: %s', service, server_id, e)
+            return 400
+
+        if not isinstance(event, dict):
+            self.logger.error('Unexpected webhook for %s-%s. Discarding.', service, server_id)
+            return 400
+
+        getattr(self, service)(collector, event)
+        return 204
+
+    def sonarr(self, collector, event):
+        event_type = event.get('eventType')
+        if event_type == 'Test':
+            return
+        # Run the pollers rather than build points from the event, so the series match what they write
+        if collector.server.queue:
+            self.submit(collector.get_queue)
+        if event_type != 'Grab' and collector.server.missing_days > 0:
+            # Imports, upgrades and deletes also change what is missing
+            self.submit(collector.get_calendar, query='Missing')
+
+    lidarr = sonarr
+
+    def radarr(self, collector, event):
+        event_type = event.get('eventType')
+        if event_type == 'Test':
+            return
+        if collector.server.queue:
+            self.submit(collector.get_queue)
+        if event_type != 'Grab' and collector.server.get_missing:
+            self.submit(collector.get_missing)
+
+    def overseerr(self, collector, event):
+        if not event.get('request'):
+            # Test notifications and issue events have no request
+            return
+        if collector.server.num_latest_requests_to_fetch > 0:
+            self.submit(collector.get_latest_requests)
+        if collector.server.get_request_total_counts:
+            self.submit(collector.get_request_counts)
+
+    def tautulli(self, collector, event):
+        # Tautulli webhook bodies are user defined, so any notification just polls the current activity
+        if collector.server.get_activity:
+            self.submit(collector.get_activity)